@@ -0,0 +1,45 @@
+#
+#      Copyright (C) 2012 Tommy Winther
+#      http://tommy.winther.nu
+#
+#  This Program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2, or (at your option)
+#  any later version.
+#
+#  This Program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this Program; see the file LICENSE.txt.  If not, write to
+#  the Free Software Foundation, 675 Mass Ave, Cambridge, MA 02139, USA.
+#  http://www.gnu.org/copyleft/gpl.html
+#
+#  Developer check, not used by the addon. Logs the query plan of getProgramList(..) for the database of the
+#  configured source and reports whether it searches program_list_idx. Run it from XBMC with
+#  RunScript(<path to this file>), tests/test_queryplan.py checks the same outside XBMC.
+#
+import xbmc
+import xbmcaddon
+import xbmcgui
+import source as src
+from strings import *
+
+ADDON = xbmcaddon.Addon(id = 'script.tvguide')
+
+source = src.instantiateSource(ADDON)
+try:
+    (usesIndex, plan) = source._checkProgramListQueryPlan(source.getReadConnection().cursor())
+finally:
+    source.close()
+
+for detail in plan:
+    xbmc.log('[script.tvguide] getProgramList query plan: %s' % detail, xbmc.LOGNOTICE)
+
+indexName = src.Source.PROGRAM_INDEXES[0][0]
+if usesIndex:
+    xbmcgui.Dialog().ok(ADDON.getAddonInfo('name'), strings(QUERY_PLAN_INDEX_USED, indexName))
+else:
+    xbmcgui.Dialog().ok(ADDON.getAddonInfo('name'), strings(QUERY_PLAN_INDEX_NOT_USED, indexName), '; '.join(plan))
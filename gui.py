@@ -19,6 +19,7 @@
 #
 import datetime
 import threading
+import bisect
 
 import xbmc
 import xbmcgui
@@ -88,8 +89,9 @@ class SourceInitializer(threading.Thread):
 
 
 class SourceUpdater(threading.Thread):
-    def __init__(self, sourceUpdatedHandler, source, channelStart, startTime, scrollEvent, progressCallback):
+    def __init__(self, sourceUpdatedHandler, source, startTime, progressCallback):
         """
+        Updates the source in the background, the guide keeps showing existing data until the update is complete.
 
         @param sourceUpdatedHandler:
         @type sourceUpdatedHandler: TVGuide
@@ -97,18 +99,53 @@ class SourceUpdater(threading.Thread):
         super(SourceUpdater, self).__init__()
         self.sourceUpdatedHandler = sourceUpdatedHandler
         self.source = source
-        self.channelStart = channelStart
         self.startTime = startTime
-        self.scrollEvent = scrollEvent
         self.progressCallback = progressCallback
 
     @buggalo.buggalo_try_except({'method' : 'SourceUpdater.run'})
     def run(self):
         try:
             self.source.updateChannelAndProgramListCaches(self.startTime, self.progressCallback, clearExistingProgramList = False)
-            self.sourceUpdatedHandler.onRedrawEPG(self.channelStart, self.startTime, self.scrollEvent)
+            self.sourceUpdatedHandler.onSourceUpdated()
+        except src.SourceUpdateInProgressException, ex:
+            # another process, such as the service, is updating, its data is shown once it is done
+            xbmc.log('[script.tvguide] database update in progress...: %s' % str(ex), xbmc.LOGDEBUG)
+            self.sourceUpdatedHandler.onSourceUpdateInProgress()
+            while not xbmc.abortRequested and not self.sourceUpdatedHandler.isClosing and self.source.isImportInProgress():
+                xbmc.sleep(1000)
+            self.source.clearImportedData()
+            self.sourceUpdatedHandler.onSourceUpdated()
+        except src.SourceException:
+            self.sourceUpdatedHandler.onSourceUpdateError()
+
+
+class ChannelBackfiller(threading.Thread):
+    def __init__(self, sourceUpdatedHandler, source, channels, progressCallback, previousUpdater):
+        """
+        Imports the programs of channels made visible in the background, see Source.backfillChannels(..)
+
+        @param sourceUpdatedHandler:
+        @type sourceUpdatedHandler: TVGuide
+        @param previousUpdater: update still running, it skipped the channels and has to finish first
+        """
+        super(ChannelBackfiller, self).__init__()
+        self.sourceUpdatedHandler = sourceUpdatedHandler
+        self.source = source
+        self.channels = channels
+        self.progressCallback = progressCallback
+        self.previousUpdater = previousUpdater
+
+    @buggalo.buggalo_try_except({'method' : 'ChannelBackfiller.run'})
+    def run(self):
+        if self.previousUpdater is not None:
+            self.previousUpdater.join()
+        if self.sourceUpdatedHandler.isClosing:
+            return
+        try:
+            if self.source.backfillChannels(self.channels, self.progressCallback):
+                self.sourceUpdatedHandler.onSourceUpdated()
         except src.SourceException:
-            self.sourceUpdatedHandler.onEPGLoadError()
+            xbmc.log('[script.tvguide] Unable to import programs of channels made visible', xbmc.LOGDEBUG)
 
 
 class TimeBarMover(threading.Thread):
@@ -127,6 +164,88 @@ class TimeBarMover(threading.Thread):
             self.gui.updateTimeBar()
             xbmc.sleep(500)
 
+class LatestRequestWorker(threading.Thread):
+    def __init__(self, gui):
+        """
+        Handles requests of the gui one at a time. Only the latest request is kept, a request made while
+        another one is handled replaces any request still waiting.
+
+        @param gui:
+        @type gui: TVGuide
+        """
+        super(LatestRequestWorker, self).__init__()
+        self.setDaemon(True)
+        self.gui = gui
+        self.condition = threading.Condition()
+        self.request = None
+        self.generation = 0
+
+    def submit(self, *request):
+        self.condition.acquire()
+        try:
+            self.request = request
+            self.generation += 1
+            self.condition.notify()
+        finally:
+            self.condition.release()
+
+    def isSuperseded(self, generation):
+        """
+        @return: True if a request was made after the one with this generation, or the gui is closing
+        """
+        return generation != self.generation or self.gui.isClosing
+
+    def run(self):
+        while not xbmc.abortRequested and not self.gui.isClosing:
+            self.condition.acquire()
+            try:
+                if self.request is None:
+                    self.condition.wait(0.5)
+                request = self.request
+                generation = self.generation
+                self.request = None
+            finally:
+                self.condition.release()
+
+            if request is not None:
+                self.handle(generation, *request)
+
+    def handle(self, generation, *request):
+        pass
+
+class ProgramListPrefetcher(LatestRequestWorker):
+    """
+    Reads the pages next to the page in view into the page cache of the source, so moving to them
+    doesn't wait for the database. Pages of a view the user has already moved away from are skipped.
+    """
+    @buggalo.buggalo_try_except({'method' : 'ProgramListPrefetcher.run'})
+    def run(self):
+        super(ProgramListPrefetcher, self).run()
+
+    def handle(self, generation, channelStart, viewStartDate):
+        channels = self.gui.source.getChannelList()
+        if not channels:
+            return
+        twoHours = datetime.timedelta(hours = 2)
+        for pageStart, startDate in [(channelStart, viewStartDate + twoHours), (channelStart + CHANNELS_PER_PAGE, viewStartDate),
+                                     (channelStart, viewStartDate - twoHours), (channelStart - CHANNELS_PER_PAGE, viewStartDate)]:
+            if self.isSuperseded(generation):
+                break # the user has moved on
+            pageStart = self.gui.wrapChannelStart(pageStart, len(channels))
+            self.gui.source.getProgramList(channels[pageStart : pageStart + CHANNELS_PER_PAGE], startDate)
+
+class EPGRedrawer(LatestRequestWorker):
+    """
+    Redraws the guide away from the gui callback thread. Moves made while a page is read replace the
+    request, so a held down key draws the page it stops at instead of every page on the way.
+    """
+    @buggalo.buggalo_try_except({'method' : 'EPGRedrawer.run'})
+    def run(self):
+        super(EPGRedrawer, self).run()
+
+    def handle(self, generation, channelStart, startTime, focusFunction):
+        self.gui.redrawEPG(channelStart, startTime, focusFunction, lambda: self.isSuperseded(generation))
+
 class Point(object):
     def __init__(self):
         self.x = self.y = 0
@@ -139,9 +258,151 @@ class EPGView(object):
         self.top = self.left = self.right = self.bottom = self.width = self.cellHeight = 0
 
 class ControlAndProgram(object):
-    def __init__(self, control, program):
+    def __init__(self, control, program, left = 0, top = 0, width = 0, height = 0):
+        """
+        The position and size are those the control was laid out with, so they can be used without asking the control.
+        """
         self.control = control
         self.program = program
+        self.controlId = None
+        self.left = left
+        self.top = top
+        self.width = width
+        self.height = height
+
+    def center(self):
+        point = Point()
+        point.x = self.left + (self.width / 2)
+        point.y = self.top + (self.height / 2)
+        return point
+
+class NavigationIndex(object):
+    def __init__(self, controlAndProgramList):
+        """
+        Program controls of a page grouped in rows and sorted from left to right, for finding the control to
+        move focus to without asking controls for their position.
+
+        @param controlAndProgramList: list of ControlAndProgram with the control id set
+        """
+        self.byControl = dict()
+        self.byControlId = dict()
+        rows = dict()
+        for elem in controlAndProgramList:
+            self.byControl[id(elem.control)] = elem
+            self.byControlId[elem.controlId] = elem
+            rows.setdefault(elem.top, list()).append(elem)
+
+        self.rows = list()
+        for top in sorted(rows.keys()):
+            row = sorted(rows[top], key = lambda elem: elem.left)
+            self.rows.append((row[0].center().y, row, [elem.left for elem in row], [elem.center().x for elem in row]))
+
+    def get(self, control):
+        """
+        @return: the ControlAndProgram of the control, or None
+        """
+        return self.byControl.get(id(control))
+
+    def getById(self, controlId):
+        return self.byControlId.get(controlId)
+
+    def onRight(self, point):
+        for centerY, row, lefts, centers in self.rows:
+            if centerY == point.y:
+                idx = bisect.bisect_right(centers, point.x)
+                if idx < len(row):
+                    return row[idx]
+        return None
+
+    def onLeft(self, point):
+        for centerY, row, lefts, centers in self.rows:
+            if centerY == point.y:
+                idx = bisect.bisect_left(centers, point.x) - 1
+                if idx >= 0:
+                    return row[idx]
+        return None
+
+    def below(self, point):
+        for centerY, row, lefts, centers in self.rows:
+            if point.y < centerY:
+                elem = self._containing(row, lefts, point.x)
+                if elem is not None:
+                    return elem
+        return None
+
+    def above(self, point):
+        for centerY, row, lefts, centers in reversed(self.rows):
+            if point.y > centerY:
+                elem = self._containing(row, lefts, point.x)
+                if elem is not None:
+                    return elem
+        return None
+
+    def at(self, point):
+        for centerY, row, lefts, centers in self.rows:
+            if row[0].top <= point.y <= row[0].top + row[0].height:
+                idx = bisect.bisect_right(lefts, point.x) - 1
+                if idx >= 0 and point.x <= row[idx].left + row[idx].width:
+                    return row[idx]
+        return None
+
+    def _containing(self, row, lefts, x):
+        idx = bisect.bisect_right(lefts, x) - 1
+        if idx >= 0 and x < row[idx].left + row[idx].width:
+            return row[idx]
+        return None
+
+class ControlButtonPool(object):
+    def __init__(self):
+        """
+        Program buttons stay in the window between redraws and are reused for the next page, creating and
+        removing controls is slow. The textures of a button can't be changed, so buttons are kept per pair
+        of textures.
+        """
+        self.buttons = dict()
+        self.unused = dict()
+        self.textures = dict()
+        self.hidden = set()
+
+    def reset(self):
+        """
+        Make all buttons available for the next page, they stay where they are until reused or hidden.
+        """
+        self.unused = dict()
+        for textures, buttons in self.buttons.items():
+            # reused in the order they were created
+            self.unused[textures] = list(reversed(buttons))
+
+    def get(self, textures):
+        """
+        @param textures: tuple of the no focus and focus texture
+        @return: an unused button with the textures, or None if a new button is needed
+        """
+        unused = self.unused.get(textures)
+        if not unused:
+            return None
+        button = unused.pop()
+        if id(button) in self.hidden:
+            button.setVisible(True)
+            self.hidden.discard(id(button))
+        return button
+
+    def add(self, textures, button):
+        self.buttons.setdefault(textures, list()).append(button)
+        self.textures[id(button)] = textures
+
+    def release(self, button):
+        """
+        Make a single button of the page in view available again, it is hidden by hideUnused unless reused first.
+        """
+        self.unused.setdefault(self.textures[id(button)], list()).append(button)
+
+    def hideUnused(self):
+        for buttons in self.unused.values():
+            for button in buttons:
+                if id(button) not in self.hidden:
+                    button.setVisible(False)
+                    self.hidden.add(id(button))
 
 class TVGuide(xbmcgui.WindowXML):
     C_MAIN_DATE = 4000
@@ -178,10 +439,18 @@ class TVGuide(xbmcgui.WindowXML):
     def __init__(self):
         super(TVGuide, self).__init__()
         self.source = None
+        self.sourceUpdater = None
+        self.prefetcher = None
+        self.redrawer = None
         self.notification = None
-        self.redrawingEPG = False
         self.isClosing = False
+        # held while the EPGRedrawer thread changes the controls of the page, and while gui callbacks use them
+        self.epgLock = threading.RLock()
         self.controlAndProgramList = list()
+        self.controlPool = ControlButtonPool()
+        self.controlIds = dict()
+        self.navigationIndex = NavigationIndex([])
+        self.drawnPage = None
         self.ignoreMissingControlIds = list()
         self.channelIdx = 0
         self.focusPoint = Point()
@@ -198,6 +467,7 @@ class TVGuide(xbmcgui.WindowXML):
         self.currentChannel = None
 
         self.osdEnabled = ADDON.getSetting('enable.osd') == 'true'
+        self.halfHourScroll = ADDON.getSetting('scroll.half.hour') == 'true'
         self.osdChannel = None
         self.osdProgram = None
 
@@ -219,6 +489,10 @@ class TVGuide(xbmcgui.WindowXML):
     def close(self):
         if not self.isClosing:
             self.isClosing = True
+            for worker in [self.prefetcher, self.redrawer]:
+                # close may be called by the redrawer itself
+                if worker is not None and worker is not threading.currentThread():
+                    worker.join()
             if self.source:
                 while self.source.updateInProgress:
                     xbmc.sleep(500)
@@ -334,51 +608,56 @@ class TVGuide(xbmcgui.WindowXML):
             if self.source.isPlaying():
                 self._hideEpg()
 
-        controlInFocus = None
-        currentFocus = self.focusPoint
+        contextMenuProgram = None
+        self.epgLock.acquire()
         try:
-            controlInFocus = self.getFocus()
-            if controlInFocus in [elem.control for elem in self.controlAndProgramList]:
-                (left, top) = controlInFocus.getPosition()
-                currentFocus = Point()
-                currentFocus.x = left + (controlInFocus.getWidth() / 2)
-                currentFocus.y = top + (controlInFocus.getHeight() / 2)
-        except Exception:
-            control = self._findControlAt(self.focusPoint)
-            if control is None and len(self.controlAndProgramList) > 0:
-                control = self.controlAndProgramList[0].control
-            if control is not None:
-                self.setFocus(control)
-                return
-
-        if action.getId() == ACTION_LEFT:
-            self._left(currentFocus)
-        elif action.getId() == ACTION_RIGHT:
-            self._right(currentFocus)
-        elif action.getId() == ACTION_UP:
-            self._up(currentFocus)
-        elif action.getId() == ACTION_DOWN:
-            self._down(currentFocus)
-        elif action.getId() == ACTION_NEXT_ITEM:
-            self._nextDay()
-        elif action.getId() == ACTION_PREV_ITEM:
-            self._previousDay()
-        elif action.getId() == ACTION_PAGE_UP:
-            self._moveUp(CHANNELS_PER_PAGE)
-        elif action.getId() == ACTION_PAGE_DOWN:
-            self._moveDown(CHANNELS_PER_PAGE)
-        elif action.getId() == ACTION_MOUSE_WHEEL_UP:
-            self._moveUp(scrollEvent = True)
-        elif action.getId() == ACTION_MOUSE_WHEEL_DOWN:
-            self._moveDown(scrollEvent = True)
-        elif action.getId() == KEY_HOME:
-            self.viewStartDate = datetime.datetime.today()
-            self.viewStartDate -= datetime.timedelta(minutes = self.viewStartDate.minute % 30, seconds = self.viewStartDate.second)
-            self.onRedrawEPG(self.channelIdx, self.viewStartDate)
-        elif action.getId() in [KEY_CONTEXT_MENU] and controlInFocus is not None:
-            program = self._getProgramFromControl(controlInFocus)
-            if program is not None:
-                self._showContextMenu(program)
+            controlInFocus = None
+            currentFocus = self.focusPoint
+            try:
+                elem = self.navigationIndex.getById(self.getFocusId())
+                if elem is not None:
+                    controlInFocus = elem.control
+                    currentFocus = elem.center()
+            except Exception:
+                control = self._findControlAt(self.focusPoint)
+                if control is None and len(self.controlAndProgramList) > 0:
+                    control = self.controlAndProgramList[0].control
+                if control is not None:
+                    self.setFocus(control)
+                    return
+
+            if action.getId() == ACTION_LEFT:
+                self._left(currentFocus)
+            elif action.getId() == ACTION_RIGHT:
+                self._right(currentFocus)
+            elif action.getId() == ACTION_UP:
+                self._up(currentFocus)
+            elif action.getId() == ACTION_DOWN:
+                self._down(currentFocus)
+            elif action.getId() == ACTION_NEXT_ITEM:
+                self._nextDay()
+            elif action.getId() == ACTION_PREV_ITEM:
+                self._previousDay()
+            elif action.getId() == ACTION_PAGE_UP:
+                self._moveUp(CHANNELS_PER_PAGE)
+            elif action.getId() == ACTION_PAGE_DOWN:
+                self._moveDown(CHANNELS_PER_PAGE)
+            elif action.getId() == ACTION_MOUSE_WHEEL_UP:
+                self._moveUp(scrollEvent = True)
+            elif action.getId() == ACTION_MOUSE_WHEEL_DOWN:
+                self._moveDown(scrollEvent = True)
+            elif action.getId() == KEY_HOME:
+                self.viewStartDate = datetime.datetime.today()
+                self.viewStartDate -= datetime.timedelta(minutes = self.viewStartDate.minute % 30, seconds = self.viewStartDate.second)
+                self.onRedrawEPG(self.channelIdx, self.viewStartDate)
+            elif action.getId() in [KEY_CONTEXT_MENU] and controlInFocus is not None:
+                contextMenuProgram = self._getProgramFromControl(controlInFocus)
+        finally:
+            self.epgLock.release()
+
+        # the menu is shown without the lock, so the page can be redrawn meanwhile
+        if contextMenuProgram is not None:
+            self._showContextMenu(contextMenuProgram)
 
 
     @buggalo.buggalo_try_except({'method' : 'TVGuide.onClick'})
@@ -411,7 +690,7 @@ class TVGuide(xbmcgui.WindowXML):
             return
 
 
-        program = self._getProgramFromControl(self.getControl(controlId))
+        program = self._getProgramFromControlId(controlId)
         if program is None:
             return
 
@@ -445,11 +724,12 @@ class TVGuide(xbmcgui.WindowXML):
 
         if buttonClicked == PopupMenu.C_POPUP_REMIND:
             if program.notificationScheduled:
-                self.notification.delProgram(program)
+                request = self.notification.delProgram(program)
             else:
-                self.notification.addProgram(program)
+                request = self.notification.addProgram(program)
 
-            self.onRedrawEPG(self.channelIdx, self.viewStartDate)
+            # redraw once the change is stored, without waiting for it here
+            request.addDoneCallback(self.onNotificationChanged)
 
         elif buttonClicked == PopupMenu.C_POPUP_CHOOSE_STREAM:
             d = StreamSetupDialog(self.source, program.channel)
@@ -463,6 +743,10 @@ class TVGuide(xbmcgui.WindowXML):
         elif buttonClicked == PopupMenu.C_POPUP_CHANNELS:
             d = ChannelsMenu(self.source)
             d.doModal()
+            if d.unhiddenChannels:
+                # takes the place of the source updater, so a new update doesn't start until it is done
+                self.sourceUpdater = ChannelBackfiller(self, self.source, d.unhiddenChannels, self.onSourceProgressUpdate, self.sourceUpdater)
+                self.sourceUpdater.start()
             del d
             self.onRedrawEPG(self.channelIdx, self.viewStartDate)
 
@@ -475,27 +759,26 @@ class TVGuide(xbmcgui.WindowXML):
             self.setFocus(control)
 
     def setFocus(self, control):
-        debug('setFocus %d' % control.getId())
-        if control in [elem.control for elem in self.controlAndProgramList]:
-            debug('Focus before %s' % self.focusPoint)
-            (left, top) = control.getPosition()
-            if left > self.focusPoint.x or left + control.getWidth() < self.focusPoint.x:
-                self.focusPoint.x = left
-            self.focusPoint.y = top + (control.getHeight() / 2)
-            debug('New focus at %s' % self.focusPoint)
-
-        super(TVGuide, self).setFocus(control)
+        self.epgLock.acquire()
+        try:
+            elem = self.navigationIndex.get(control)
+            if elem is not None:
+                debug('Focus before %s' % self.focusPoint)
+                if elem.left > self.focusPoint.x or elem.left + elem.width < self.focusPoint.x:
+                    self.focusPoint.x = elem.left
+                self.focusPoint.y = elem.center().y
+                debug('New focus at %s' % self.focusPoint)
+
+            super(TVGuide, self).setFocus(control)
+        finally:
+            self.epgLock.release()
 
     @buggalo.buggalo_try_except({'method' : 'TVGuide.onFocus'})
     def onFocus(self, controlId):
-        try:
-            controlInFocus = self.getControl(controlId)
-        except Exception:
-            return
-
-        program = self._getProgramFromControl(controlInFocus)
+        program = self._getProgramFromControlId(controlId)
         if program is None:
             return
+        program = self.source.getProgramDetails(program)
 
         self.setControlLabel(self.C_MAIN_TITLE, '[B]%s[/B]' % program.title)
         self.setControlLabel(self.C_MAIN_TIME, '[B]%s - %s[/B]' % (self.formatTime(program.startDate), self.formatTime(program.endDate)))
@@ -520,6 +803,12 @@ class TVGuide(xbmcgui.WindowXML):
         control = self._findControlOnLeft(currentFocus)
         if control is not None:
             self.setFocus(control)
+        elif self.halfHourScroll:
+            self.viewStartDate -= HALF_HOUR
+            # focus the program ending where the view started, or the focused one if it started earlier
+            self.focusPoint.x = self._secondsToXposition(HALF_HOUR.seconds) - 3
+            self.onRedrawEPG(self.channelIdx, self.viewStartDate,
+                             focusFunction = lambda point: self._findControlAt(point) or self._findControlOnLeft(point))
         elif control is None:
             self.viewStartDate -= datetime.timedelta(hours = 2)
             self.focusPoint.x = self.epgView.right
@@ -529,6 +818,12 @@ class TVGuide(xbmcgui.WindowXML):
         control = self._findControlOnRight(currentFocus)
         if control is not None:
             self.setFocus(control)
+        elif self.halfHourScroll:
+            self.viewStartDate += HALF_HOUR
+            # focus the program starting where the view ended, or the focused one if it ends later
+            self.focusPoint.x = self._secondsToXposition(7200 - HALF_HOUR.seconds)
+            self.onRedrawEPG(self.channelIdx, self.viewStartDate,
+                             focusFunction = lambda point: self._findControlAt(point) or self._findControlOnRight(point))
         elif control is None:
             self.viewStartDate += datetime.timedelta(hours = 2)
             self.focusPoint.x = self.epgView.left
@@ -606,9 +901,13 @@ class TVGuide(xbmcgui.WindowXML):
             self.osdChannel = self.currentChannel
 
         if self.osdProgram is not None:
+            self.osdProgram = self.source.getProgramDetails(self.osdProgram)
             self.setControlLabel(self.C_MAIN_OSD_TITLE, '[B]%s[/B]' % self.osdProgram.title)
             self.setControlLabel(self.C_MAIN_OSD_TIME, '[B]%s - %s[/B]' % (self.formatTime(self.osdProgram.startDate), self.formatTime(self.osdProgram.endDate)))
-            self.setControlText(self.C_MAIN_OSD_DESCRIPTION, self.osdProgram.description)
+            if self.osdProgram.description:
+                self.setControlText(self.C_MAIN_OSD_DESCRIPTION, self.osdProgram.description)
+            else:
+                self.setControlText(self.C_MAIN_OSD_DESCRIPTION, strings(NO_DESCRIPTION))
             self.setControlLabel(self.C_MAIN_OSD_CHANNEL_TITLE, self.osdChannel.title)
             if self.osdProgram.channel.logo is not None:
                 self.setControlImage(self.C_MAIN_OSD_CHANNEL_LOGO, self.osdProgram.channel.logo)
@@ -628,145 +927,265 @@ class TVGuide(xbmcgui.WindowXML):
         self._clearEpg()
 
     def onRedrawEPG(self, channelStart, startTime, scrollEvent = False, focusFunction = None):
-        if self.redrawingEPG or self.source.updateInProgress or self.isClosing:
-            debug('onRedrawEPG - already redrawing')
-            return # ignore redraw request while redrawing
+        if self.isClosing or self.redrawer is None:
+            return
         debug('onRedrawEPG')
 
-        self.redrawingEPG = True
+        # the page is known right away, so moves made before it is drawn continue from it
         self.mode = MODE_EPG
+        self.channelIdx = self.wrapChannelStart(channelStart, len(self.source.getChannelList()))
+        self.redrawer.submit(self.channelIdx, startTime, focusFunction)
+
+    def redrawEPG(self, channelStart, startTime, focusFunction, isSuperseded):
+        """
+        Called by the EPGRedrawer thread. The page is only drawn if no other page was requested while
+        its programs were read.
+
+        @param isSuperseded: function returning True once another page has been requested
+        """
         self._showControl(self.C_MAIN_EPG)
         self.updateTimeBar()
 
-        # show Loading screen
-        self.setControlLabel(self.C_MAIN_LOADING_TIME_LEFT, strings(CALCULATING_REMAINING_TIME))
-        self._showControl(self.C_MAIN_LOADING)
-        self.setFocusId(self.C_MAIN_LOADING_CANCEL)
-
-        # remove existing controls
-        self._clearEpg()
         if self.source.isCacheExpired(startTime):
-            self.redrawingEPG = False
-            SourceUpdater(self, self.source, channelStart, startTime, scrollEvent, self.onSourceProgressUpdate).start()
-            return
+            if self.sourceUpdater is None or not self.sourceUpdater.isAlive():
+                self.sourceUpdater = SourceUpdater(self, self.source, startTime, self.onSourceProgressUpdate)
+                self.sourceUpdater.start()
 
-        # date and time row
-        self.setControlLabel(self.C_MAIN_DATE, self.formatDate(self.viewStartDate))
-        for col in range(1, 5):
-            self.setControlLabel(4000 + col, self.formatTime(startTime))
-            startTime += HALF_HOUR
+            # existing data is shown while the update runs in the background
+            if not self.source.getChannelList():
+                # show Loading screen
+                self.setControlLabel(self.C_MAIN_LOADING_TIME_LEFT, strings(CALCULATING_REMAINING_TIME))
+                self._showControl(self.C_MAIN_LOADING)
+                self.setFocusId(self.C_MAIN_LOADING_CANCEL)
+                self._clearEpg()
+                return
 
         # channels
         channels = self.source.getChannelList()
-        if channelStart < 0:
-            channelStart = len(channels) - 1
-        elif channelStart > len(channels) - 1:
-            channelStart = 0
-
+        channelStart = self.wrapChannelStart(channelStart, len(channels))
         channelEnd = channelStart + CHANNELS_PER_PAGE
-        self.channelIdx = channelStart
-
         channelsToShow = channels[channelStart : channelEnd]
-        programs = self.source.getProgramList(channelsToShow, self.viewStartDate)
+        page = (tuple([channel.id for channel in channelsToShow]), startTime)
+        halfHourScroll = self._isHalfHourScroll(page)
+        if halfHourScroll:
+            # only the half hour coming into view is read
+            if startTime > self.drawnPage[1]:
+                programs = self.source.getProgramList(channelsToShow, self.drawnPage[1] + datetime.timedelta(hours = 2), startTime + datetime.timedelta(hours = 2))
+            else:
+                programs = self.source.getProgramList(channelsToShow, startTime, self.drawnPage[1])
+        else:
+            programs = self.source.getProgramList(channelsToShow, startTime)
 
         if programs is None:
             self.onEPGLoadError()
             return
 
-        # set channel logo or text
-        for idx in range(0, CHANNELS_PER_PAGE):
-            if idx >= len(channelsToShow):
-                self.setControlImage(4110 + idx, '')
-                self.setControlLabel(4010 + idx, '')
+        # gui callbacks wait while the controls are changed, they use the page in view until then
+        self.epgLock.acquire()
+        try:
+            if isSuperseded():
+                debug('redrawEPG - skipping page, another page was requested')
+                return
+
+            viewStartTime = src.toEpoch(startTime)
+            rows = dict([(channel.id, idx) for idx, channel in enumerate(channelsToShow)])
+            newControls = list()
+            controlAndProgramList = list()
+            if halfHourScroll:
+                # cells of programs still in view are moved, the others are hidden unless reused below
+                shownPrograms = set()
+                for elem in self.controlAndProgramList:
+                    if self._moveProgramControl(elem, rows[elem.program.channel.id], viewStartTime):
+                        controlAndProgramList.append(elem)
+                        shownPrograms.add((elem.program.channel.id, elem.program.startDate))
+                    else:
+                        self.controlPool.release(elem.control)
+                programs = [program for program in programs if (program.channel.id, program.startDate) not in shownPrograms]
+            else:
+                # existing controls are reused for the new page
+                self.controlPool.reset()
+
+            # date and time row
+            self.setControlLabel(self.C_MAIN_DATE, self.formatDate(startTime))
+            columnTime = startTime
+            for col in range(1, 5):
+                self.setControlLabel(4000 + col, self.formatTime(columnTime))
+                columnTime += HALF_HOUR
+
+            # set channel logo or text
+            if not halfHourScroll:
+                for idx in range(0, CHANNELS_PER_PAGE):
+                    if idx >= len(channelsToShow):
+                        self.setControlImage(4110 + idx, '')
+                        self.setControlLabel(4010 + idx, '')
+                    else:
+                        channel = channelsToShow[idx]
+                        self.setControlLabel(4010 + idx, channel.title)
+                        if channel.logo is not None:
+                            self.setControlImage(4110 + idx, channel.logo)
+                        else:
+                            self.setControlImage(4110 + idx, '')
+
+            for program in programs:
+                elem = self._addProgramControl(program, rows[program.channel.id], viewStartTime, newControls)
+                if elem is not None:
+                    controlAndProgramList.append(elem)
+
+            # add new program controls, hide the ones not used by this page
+            if self.hasAddControls:
+                self.addControls(newControls)
             else:
-                channel = channelsToShow[idx]
-                self.setControlLabel(4010 + idx, channel.title)
-                if channel.logo is not None:
-                    self.setControlImage(4110 + idx, channel.logo)
-                else:
-                    self.setControlImage(4110 + idx, '')
-
-        for program in programs:
-            idx = channelsToShow.index(program.channel)
-
-            startDelta = program.startDate - self.viewStartDate
-            stopDelta = program.endDate - self.viewStartDate
-
-            cellStart = self._secondsToXposition(startDelta.seconds)
-            if startDelta.days < 0:
-                cellStart = self.epgView.left
-            cellWidth = self._secondsToXposition(stopDelta.seconds) - cellStart
-            if cellStart + cellWidth > self.epgView.right:
-                cellWidth = self.epgView.right - cellStart
-
-            if cellWidth > 1:
-                if program.notificationScheduled:
-                    noFocusTexture = 'tvguide-program-red.png'
-                    focusTexture = 'tvguide-program-red-focus.png'
-                else:
-                    noFocusTexture = 'tvguide-program-grey.png'
-                    focusTexture = 'tvguide-program-grey-focus.png'
-
-                if cellWidth < 25:
-                    title = '' # Text will overflow outside the button if it is too narrow
-                else:
-                    title = program.title
-
-                control = xbmcgui.ControlButton(
-                    cellStart,
-                    self.epgView.top + self.epgView.cellHeight * idx,
-                    cellWidth - 2,
-                    self.epgView.cellHeight - 2,
-                    title,
-                    noFocusTexture = noFocusTexture,
-                    focusTexture = focusTexture
-                )
-
-                self.controlAndProgramList.append(ControlAndProgram(control, program))
-
-        # add program controls
-        if focusFunction is None:
-            focusFunction = self._findControlAt
-        focusControl = focusFunction(self.focusPoint)
-        if self.hasAddControls:
-            controls = [elem.control for elem in self.controlAndProgramList]
-            self.addControls(controls)
+                for control in newControls:
+                    self.addControl(control)
+            self.controlPool.hideUnused()
+            for control in newControls:
+                self.controlIds[id(control)] = control.getId()
+                self.ignoreMissingControlIds.append(self.controlIds[id(control)])
+            for elem in controlAndProgramList:
+                elem.controlId = self.controlIds[id(elem.control)]
+            # the new page replaces the old one at once, gui callbacks never see part of both
+            self.controlAndProgramList = controlAndProgramList
+            self.navigationIndex = NavigationIndex(controlAndProgramList)
+
+            if focusFunction is None:
+                focusFunction = self._findControlAt
+            focusControl = focusFunction(self.focusPoint)
             if focusControl is not None:
-                debug('onRedrawEPG - setFocus %d' % focusControl.getId())
+                debug('onRedrawEPG - setFocus %d' % self.navigationIndex.get(focusControl).controlId)
                 self.setFocus(focusControl)
+
+            if focusControl is None and len(self.controlAndProgramList) > 0:
+                self.setFocus(self.controlAndProgramList[0].control)
+
+            self._hideControl(self.C_MAIN_LOADING)
+            self.drawnPage = page
+        finally:
+            self.epgLock.release()
+
+        if self.prefetcher is not None:
+            self.prefetcher.submit(self.channelIdx, startTime)
+
+    def _isHalfHourScroll(self, page):
+        """
+        @param page: tuple of the ids of the channels on the page and the start time
+        @return: True if the page is the page in view moved half an hour to the left or right
+        """
+        if not self.halfHourScroll or self.drawnPage is None or page[0] != self.drawnPage[0]:
+            return False
+        return page[1] - self.drawnPage[1] in [HALF_HOUR, -HALF_HOUR]
+
+    def _layoutProgram(self, program, viewStartTime):
+        """
+        @return: left and width of the program's cell, the width is 1 or less if the program is not in view
+        """
+        startDelta = program.startDate - viewStartTime
+        stopDelta = program.endDate - viewStartTime
+
+        cellStart = self._secondsToXposition(startDelta)
+        if startDelta < 0:
+            cellStart = self.epgView.left
+        cellWidth = self._secondsToXposition(stopDelta) - cellStart
+        if cellStart + cellWidth > self.epgView.right:
+            cellWidth = self.epgView.right - cellStart
+        return cellStart, cellWidth
+
+    def _programControlTitle(self, program, cellWidth):
+        if cellWidth < 25:
+            return '' # Text will overflow outside the button if it is too narrow
+        return program.title
+
+    def _addProgramControl(self, program, idx, viewStartTime, newControls):
+        """
+        Lays out the cell of a program in an unused button, or a new one which is appended to newControls.
+
+        @param idx: row of the program's channel on the page
+        @return: ControlAndProgram, or None if the program is not in view
+        """
+        cellStart, cellWidth = self._layoutProgram(program, viewStartTime)
+        if cellWidth <= 1:
+            return None
+
+        if program.notificationScheduled:
+            noFocusTexture = 'tvguide-program-red.png'
+            focusTexture = 'tvguide-program-red-focus.png'
+        else:
+            noFocusTexture = 'tvguide-program-grey.png'
+            focusTexture = 'tvguide-program-grey-focus.png'
+
+        title = self._programControlTitle(program, cellWidth)
+        top = self.epgView.top + self.epgView.cellHeight * idx
+
+        textures = (noFocusTexture, focusTexture)
+        control = self.controlPool.get(textures)
+        if control is None:
+            control = xbmcgui.ControlButton(
+                cellStart,
+                top,
+                cellWidth - 2,
+                self.epgView.cellHeight - 2,
+                title,
+                noFocusTexture = noFocusTexture,
+                focusTexture = focusTexture
+            )
+            self.controlPool.add(textures, control)
+            newControls.append(control)
         else:
-            for elem in self.controlAndProgramList:
-                self.addControl(elem.control)
-                if elem.control == focusControl:
-                    debug('onRedrawEPG - setFocus %d' % focusControl.getId())
-                    self.setFocus(focusControl)
+            control.setPosition(cellStart, top)
+            control.setWidth(cellWidth - 2)
+            control.setHeight(self.epgView.cellHeight - 2)
+            control.setLabel(title)
 
-        self.ignoreMissingControlIds.extend([elem.control.getId() for elem in self.controlAndProgramList])
+        return ControlAndProgram(control, program, cellStart, top, cellWidth - 2, self.epgView.cellHeight - 2)
 
-        if focusControl is None and len(self.controlAndProgramList) > 0:
-            self.setFocus(self.controlAndProgramList[0].control)
+    def _moveProgramControl(self, elem, idx, viewStartTime):
+        """
+        Moves the cell of a program shown on the page to a new view start time, the control is only
+        updated where the cell changes.
 
-        self._hideControl(self.C_MAIN_LOADING)
-        self.redrawingEPG = False
+        @type elem: ControlAndProgram
+        @param idx: row of the program's channel on the page
+        @return: False if the program is no longer in view
+        """
+        cellStart, cellWidth = self._layoutProgram(elem.program, viewStartTime)
+        if cellWidth <= 1:
+            return False
+
+        top = self.epgView.top + self.epgView.cellHeight * idx
+        if cellStart != elem.left or top != elem.top:
+            elem.control.setPosition(cellStart, top)
+        if cellWidth - 2 != elem.width:
+            elem.control.setWidth(cellWidth - 2)
+            title = self._programControlTitle(elem.program, cellWidth)
+            if title != self._programControlTitle(elem.program, elem.width + 2):
+                elem.control.setLabel(title)
+        elem.left = cellStart
+        elem.top = top
+        elem.width = cellWidth - 2
+        return True
+
+    def wrapChannelStart(self, channelStart, channelCount):
+        """
+        Moving up from the first page shows the last channel, moving down from the last page shows the first.
+
+        @return: index of the first channel on the page
+        """
+        if channelStart < 0:
+            return channelCount - 1
+        elif channelStart > channelCount - 1:
+            return 0
+        return channelStart
 
     def _clearEpg(self):
-        if self.hasRemoveControls:
-            controls = [elem.control for elem in self.controlAndProgramList]
-            try:
-                self.removeControls(controls)
-            except RuntimeError:
-                for elem in self.controlAndProgramList:
-                    try:
-                        self.removeControl(elem.control)
-                    except RuntimeError:
-                        pass # happens if we try to remove a control that doesn't exist
-        else:
-            for elem in self.controlAndProgramList:
-                try:
-                    self.removeControl(elem.control)
-                except RuntimeError:
-                    pass # happens if we try to remove a control that doesn't exist
-        del self.controlAndProgramList[:]
+        # the controls are hidden and kept for the next page
+        self.epgLock.acquire()
+        try:
+            self.controlPool.reset()
+            self.controlPool.hideUnused()
+            self.controlAndProgramList = list()
+            self.navigationIndex = NavigationIndex([])
+            self.drawnPage = None
+        finally:
+            self.epgLock.release()
 
     def updateTimeBar(self):
         # move timebar to current time
@@ -778,13 +1197,29 @@ class TVGuide(xbmcgui.WindowXML):
             control.setPosition(self._secondsToXposition(timeDelta.seconds), y)
 
     def onEPGLoadError(self):
-        self.redrawingEPG = False
         self._hideControl(self.C_MAIN_LOADING)
         xbmcgui.Dialog().ok(strings(LOAD_ERROR_TITLE), strings(LOAD_ERROR_LINE1), strings(LOAD_ERROR_LINE2))
         self.close()
 
+    def onSourceUpdated(self):
+        # redraw the page currently in view, unless the user is watching TV
+        if not self.isClosing and self.mode == MODE_EPG:
+            self.onRedrawEPG(self.channelIdx, self.viewStartDate)
+
+    def onNotificationChanged(self, request):
+        # called from the database writer thread, redraw in a thread of its own so the writer can continue
+        threading.Timer(0, self.onSourceUpdated).start()
+
+    def onSourceUpdateInProgress(self):
+        self.setControlLabel(self.C_MAIN_LOADING_TIME_LEFT, strings(BACKGROUND_UPDATE_IN_PROGRESS))
+
+    def onSourceUpdateError(self):
+        if self.source.getChannelList():
+            xbmc.log('[script.tvguide] Background update failed, showing existing data', xbmc.LOGDEBUG)
+        else:
+            self.onEPGLoadError()
+
     def onSourceNotConfigured(self):
-        self.redrawingEPG = False
         self._hideControl(self.C_MAIN_LOADING)
         xbmcgui.Dialog().ok(strings(LOAD_ERROR_TITLE), strings(LOAD_ERROR_LINE1), strings(CONFIGURATION_ERROR_LINE2))
         self.close()
@@ -794,9 +1229,15 @@ class TVGuide(xbmcgui.WindowXML):
         self.notification = Notification(self.source, ADDON.getAddonInfo('path'))
 
         self.setControlImage(self.C_MAIN_IMAGE, 'tvguide-logo-%s.png' % self.source.KEY)
+        self.prefetcher = ProgramListPrefetcher(self)
+        self.prefetcher.start()
+        self.redrawer = EPGRedrawer(self)
+        self.redrawer.start()
         self.onRedrawEPG(0, self.viewStartDate)
 
-    def onSourceProgressUpdate(self, percentageComplete):
+    def onSourceProgressUpdate(self, percentageComplete, programsPerSecond = None):
+        if programsPerSecond is not None:
+            debug('onSourceProgressUpdate - %d%% complete, %d programs/s' % (percentageComplete, programsPerSecond))
         control = self.getControl(self.C_MAIN_LOADING_PROGRESS)
         if percentageComplete < 1:
             if control:
@@ -829,91 +1270,37 @@ class TVGuide(xbmcgui.WindowXML):
         return self.epgView.left + (seconds * self.epgView.width / 7200)
 
     def _findControlOnRight(self, point):
-        distanceToNearest = 10000
-        nearestControl = None
-
-        for elem in self.controlAndProgramList:
-            control = elem.control
-            (left, top) = control.getPosition()
-            x = left + (control.getWidth() / 2)
-            y = top + (control.getHeight() / 2)
-
-            if point.x < x and point.y == y:
-                distance = abs(point.x - x)
-                if distance < distanceToNearest:
-                    distanceToNearest = distance
-                    nearestControl = control
-
-        return nearestControl
-
+        return self._controlOf(self.navigationIndex.onRight(point))
 
     def _findControlOnLeft(self, point):
-        distanceToNearest = 10000
-        nearestControl = None
-
-        for elem in self.controlAndProgramList:
-            control = elem.control
-            (left, top) = control.getPosition()
-            x = left + (control.getWidth() / 2)
-            y = top + (control.getHeight() / 2)
-
-            if point.x > x and point.y == y:
-                distance = abs(point.x - x)
-                if distance < distanceToNearest:
-                    distanceToNearest = distance
-                    nearestControl = control
-
-        return nearestControl
+        return self._controlOf(self.navigationIndex.onLeft(point))
 
     def _findControlBelow(self, point):
-        nearestControl = None
-
-        for elem in self.controlAndProgramList:
-            control = elem.control
-            (leftEdge, top) = control.getPosition()
-            y = top + (control.getHeight() / 2)
-
-            if point.y < y:
-                rightEdge = leftEdge + control.getWidth()
-                if(leftEdge <= point.x < rightEdge
-                   and (nearestControl is None or nearestControl.getPosition()[1] > top)):
-                    nearestControl = control
-
-        return nearestControl
+        return self._controlOf(self.navigationIndex.below(point))
 
     def _findControlAbove(self, point):
-        nearestControl = None
-        for elem in self.controlAndProgramList:
-            control = elem.control
-            (leftEdge, top) = control.getPosition()
-            y = top + (control.getHeight() / 2)
-
-            if point.y > y:
-                rightEdge = leftEdge + control.getWidth()
-                if(leftEdge <= point.x < rightEdge
-                   and (nearestControl is None or nearestControl.getPosition()[1] < top)):
-                    nearestControl = control
-
-        return nearestControl
+        return self._controlOf(self.navigationIndex.above(point))
 
     def _findControlAt(self, point):
-        for elem in self.controlAndProgramList:
-            control = elem.control
-            (left, top) = control.getPosition()
-            bottom = top + control.getHeight()
-            right = left + control.getWidth()
-
-            if left <= point.x <= right and  top <= point.y <= bottom:
-                return control
-
-        return None
+        return self._controlOf(self.navigationIndex.at(point))
 
+    def _controlOf(self, elem):
+        if elem is None:
+            return None
+        return elem.control
 
     def _getProgramFromControl(self, control):
-        for elem in self.controlAndProgramList:
-            if elem.control == control:
-                return elem.program
-        return None
+        # the index is replaced, not changed, by a redraw
+        elem = self.navigationIndex.get(control)
+        if elem is None:
+            return None
+        return elem.program
+
+    def _getProgramFromControlId(self, controlId):
+        elem = self.navigationIndex.getById(controlId)
+        if elem is None:
+            return None
+        return elem.program
 
     def _hideControl(self, *controlIds):
         """
@@ -934,6 +1321,11 @@ class TVGuide(xbmcgui.WindowXML):
                 control.setVisible(False)
 
     def formatTime(self, timestamp):
+        """
+        @param timestamp: datetime, or seconds since the epoch as used for program times
+        """
+        if not isinstance(timestamp, datetime.datetime):
+            timestamp = datetime.datetime.fromtimestamp(timestamp)
         format = xbmc.getRegion('time').replace(':%S', '')
         return timestamp.strftime(format)
 
@@ -1029,7 +1421,8 @@ class PopupMenu(xbmcgui.WindowXMLDialog):
             chooseStrmControl = self.getControl(self.C_POPUP_CHOOSE_STREAM)
             chooseStrmControl.setLabel(strings(CHOOSE_STRM_FILE))
 
-            if not self.source.isPlayable(self.program.channel):
+            # the custom stream url may not be deleted yet, only the channel's own stream is left
+            if not self.program.channel.isPlayable():
                 playControl = self.getControl(self.C_POPUP_PLAY)
                 playControl.setEnabled(False)
 
@@ -1058,6 +1451,9 @@ class ChannelsMenu(xbmcgui.WindowXMLDialog):
         super(ChannelsMenu, self).__init__()
         self.source = source
         self.channelList = source._retrieveChannelListFromDatabase(False)
+        self.hiddenChannelIds = set([channel.id for channel in self.channelList if not channel.visible])
+        # channels made visible once saved, their programs may have to be imported
+        self.unhiddenChannels = list()
         self.swapInProgress = False
 
     @buggalo.buggalo_try_except({'method' : 'ChannelsMenu.onInit'})
@@ -1113,6 +1509,7 @@ class ChannelsMenu(xbmcgui.WindowXMLDialog):
 
         elif controlId == self.C_CHANNELS_SAVE:
             self.source._storeChannelListInDatabase(self.channelList)
+            self.unhiddenChannels = [channel for channel in self.channelList if channel.visible and channel.id in self.hiddenChannelIds]
             self.close()
 
         elif controlId == self.C_CHANNELS_CANCEL:
@@ -17,8 +17,9 @@
 #  the Free Software Foundation, 675 Mass Ave, Cambridge, MA 02139, USA.
 #  http://www.gnu.org/copyleft/gpl.html
 #
-import datetime
 import os
+import time
+import datetime
 import xbmc
 import xbmcgui
 
@@ -30,20 +31,25 @@ class Notification(object):
         self.addonPath = addonPath
         self.icon = os.path.join(self.addonPath, 'icon.png')
 
-        # reuse conn for now todo less hacky
-        self.conn = self.source.conn
-
     def createAlarmClockName(self, programTitle, startTime):
         return 'tvguide-%s-%s' % (programTitle, startTime)
 
+    def createLegacyAlarmClockName(self, programTitle, startTime):
+        """
+        Name of the alarms of versions storing program times as local date and time, before database version 1.3.3.
+        Such alarms may still be scheduled after an update of the addon, so they are cancelled as well.
+        """
+        return self.createAlarmClockName(programTitle, datetime.datetime.fromtimestamp(startTime))
+
     def scheduleNotifications(self):
         xbmc.log("[script.tvguide] Scheduling notifications")
         for channelTitle, programTitle, startTime in self.getAllNotifications():
+            # an alarm of an earlier version would notify a second time
+            self._cancelAlarms(self.createLegacyAlarmClockName(programTitle, startTime))
             self._scheduleNotification(channelTitle, programTitle, startTime)
 
     def _scheduleNotification(self, channelTitle, programTitle, startTime):
-        t = startTime - datetime.datetime.now()
-        timeToNotification = ((t.days * 86400) + t.seconds) / 60
+        timeToNotification = (startTime - int(time.time())) / 60
         if timeToNotification < 0:
             return
 
@@ -58,38 +64,54 @@ class Notification(object):
                             (name.encode('utf-8', 'replace'), programTitle.encode('utf-8', 'replace'), description.encode('utf-8', 'replace'), self.icon, timeToNotification))
 
     def _unscheduleNotification(self, programTitle, startTime):
-        name = self.createAlarmClockName(programTitle, startTime)
+        self._cancelAlarms(self.createAlarmClockName(programTitle, startTime))
+        self._cancelAlarms(self.createLegacyAlarmClockName(programTitle, startTime))
+
+    def _cancelAlarms(self, name):
         xbmc.executebuiltin('CancelAlarm(%s-5mins,True)' % name.encode('utf-8', 'replace'))
         xbmc.executebuiltin('CancelAlarm(%s-now,True)' % name.encode('utf-8', 'replace'))
 
     def addProgram(self, program):
         """
         @type program: source.program
+        @return: the DatabaseWriterRequest storing the notification
         """
-        c = self.conn.cursor()
-        c.execute("INSERT INTO notifications(channel, program_title, source) VALUES(?, ?, ?)", [program.channel.id, program.title, self.source.KEY])
-        self.conn.commit()
-        c.close()
-
+        request = self.source.writer.submit(self._addProgram, program.channel.id, program.title)
+        request.addDoneCallback(self._onNotificationsStored)
         self._scheduleNotification(program.channel.title, program.title, program.startDate)
+        return request
+
+    def _addProgram(self, c, channelId, programTitle):
+        c.execute("INSERT OR IGNORE INTO notifications(channel, program_title, source) VALUES(?, ?, ?)", [channelId, programTitle, self.source.KEY])
 
     def delProgram(self, program):
         """
         @type program: source.program
+        @return: the DatabaseWriterRequest deleting the notification
         """
-        c = self.conn.cursor()
-        c.execute("DELETE FROM notifications WHERE channel=? AND program_title=? AND source=?", [program.channel.id, program.title, self.source.KEY])
-        self.conn.commit()
-        c.close()
-
+        request = self.source.writer.submit(self._delProgram, program.channel.id, program.title)
+        request.addDoneCallback(self._onNotificationsStored)
         self._unscheduleNotification(program.title, program.startDate)
+        return request
 
+    def _delProgram(self, c, channelId, programTitle):
+        c.execute("DELETE FROM notifications WHERE channel=? AND program_title=? AND source=?", [channelId, programTitle, self.source.KEY])
+
+
+    def _onNotificationsStored(self, request):
+        # pages cached by the source show the notifications they were read with
+        self.source.clearProgramListCache()
 
     def getAllNotifications(self, daysLimit = 2):
-        start = datetime.datetime.now()
-        end = start + datetime.timedelta(days = daysLimit)
-        c = self.conn.cursor()
-        c.execute("SELECT DISTINCT c.title, p.title, p.start_date FROM notifications n, channels c, programs p WHERE n.channel = c.id AND p.channel = c.id AND n.program_title = p.title AND n.source=? AND p.start_date >= ? AND p.end_date <= ?", [self.source.KEY, start, end])
+        start = int(time.time())
+        end = start + daysLimit * 86400
+        c = self.source.getReadConnection().cursor()
+        # the programs of each notified channel are found by end_date in program_list_idx, their titles are read from
+        # texts and compared with the title text stored in notifications
+        c.execute("SELECT DISTINCT c.title, t.text, p.start_date FROM notifications n, channels c, programs p, texts t "
+                  "WHERE n.source=? AND c.id=n.channel AND c.source=n.source AND p.source=n.source AND p.channel=n.channel "
+                  "AND p.end_date >= ? AND p.end_date <= ? AND p.start_date >= ? AND t.id=p.title_id AND t.text=n.program_title",
+                  [self.source.KEY, start, end, start])
         programs = c.fetchall()
         c.close()
 
@@ -99,7 +121,7 @@ class Notification(object):
         """
         @type program: source.program
         """
-        c = self.conn.cursor()
+        c = self.source.getReadConnection().cursor()
         c.execute("SELECT 1 FROM notifications WHERE channel=? AND program_title=? AND source=?", [program.channel.id, program.title, self.source.KEY])
         result = c.fetchone()
         c.close()
@@ -107,10 +129,11 @@ class Notification(object):
         return result
 
     def clearAllNotifications(self):
-        c = self.conn.cursor()
+        self.source.writer.submit(self._clearAllNotifications).result()
+        self.source.clearProgramListCache()
+
+    def _clearAllNotifications(self, c):
         c.execute('DELETE FROM notifications')
-        self.conn.commit()
-        c.close()
 
 
 if __name__ == '__main__':
@@ -22,6 +22,7 @@ import notification
 import xbmc
 import source as src
 
+source = None
 try:
     ADDON = xbmcaddon.Addon(id = 'script.tvguide')
     source = src.instantiateSource(ADDON)
@@ -36,3 +37,8 @@ try:
 
 except Exception, ex:
     xbmc.log('[script.tvguide] Uncaugt exception in service.py: %s' % str(ex) , xbmc.LOGDEBUG)
+
+finally:
+    # stops the database writer thread, which would otherwise still be running when the interpreter shuts down
+    if source is not None:
+        source.close()
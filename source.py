@@ -21,10 +21,14 @@ import StringIO
 import os, sys
 import simplejson
 import datetime
+import hashlib
+import bisect
+import re
 import threading
+import Queue
 import time
 import urllib2
-from xml.etree import ElementTree
+from xml.parsers import expat
 from strings import *
 from HTMLParser import HTMLParser
 import ysapi
@@ -36,8 +40,25 @@ from sqlite3 import dbapi2 as sqlite3
 import tarfile
 import zipfile
 
+try:
+    import multiprocessing
+except ImportError:
+    # not available on all platforms, XMLTV files are then parsed in one process
+    multiprocessing = None
+
 SETTINGS_TO_CHECK = ['source', 'youseetv.category', 'xmltv.file', 'xmltv.logo.folder', 'ontv.url', 'json.url','xmltv.url']
 
+def toEpoch(date):
+    """
+    Program times are stored as seconds since the epoch (UTC).
+
+    @param date: datetime in local time, or seconds since the epoch
+    @return: seconds since the epoch
+    """
+    if isinstance(date, datetime.datetime):
+        return int(time.mktime(date.timetuple()))
+    return int(date)
+
 class Channel(object):
     def __init__(self, id, title, logo = None, streamUrl = None, visible = True, weight = -1):
         self.id = id
@@ -55,17 +76,19 @@ class Channel(object):
                % (self.id, self.title, self.logo, self.streamUrl)
 
 class Program(object):
-    def __init__(self, channel, title, startDate, endDate, description, imageLarge = None, imageSmall=None, notificationScheduled = None):
+    def __init__(self, channel, title, startDate, endDate, description, imageLarge = None, imageSmall=None, notificationScheduled = None, id = None):
         """
 
         @param channel:
         @type channel: source.Channel
         @param title:
-        @param startDate:
-        @param endDate:
+        @param startDate: seconds since the epoch (UTC), sources may also pass a datetime in local time
+        @param endDate: seconds since the epoch (UTC), sources may also pass a datetime in local time
         @param description:
         @param imageLarge:
         @param imageSmall:
+        @param id: rowid of the program in the database, only set for programs read by getProgramList(..)
+            and getProgramDetails(..)
         """
         self.channel = channel
         self.title = title
@@ -75,11 +98,76 @@ class Program(object):
         self.imageLarge = imageLarge
         self.imageSmall = imageSmall
         self.notificationScheduled = notificationScheduled
+        self.id = id
 
     def __repr__(self):
         return 'Program(channel=%s, title=%s, startDate=%s, endDate=%s, description=%s, imageLarge=%s, imageSmall=%s)' % \
             (self.channel, self.title, self.startDate, self.endDate, self.description, self.imageLarge, self.imageSmall)
 
+class ProgramTimeline(object):
+    """
+    Start and end dates and rowids of the programs of one channel, ordered by start date.
+    Finding the current, next or previous program is a binary search.
+    """
+    def __init__(self, rows):
+        """
+        @param rows: tuples of rowid, start date and end date ordered by start date
+        """
+        self.rowIds = [row[0] for row in rows]
+        self.startDates = [row[1] for row in rows]
+        self.endDates = [row[2] for row in rows]
+        self.longestProgram = max([0] + [row[2] - row[1] for row in rows])
+
+    def current(self, now):
+        """
+        @return: index of a program running at now, or None
+        """
+        idx = bisect.bisect_right(self.startDates, now) - 1
+        # an earlier program may still be running if programs overlap
+        while idx >= 0 and self.startDates[idx] >= now - self.longestProgram:
+            if self.endDates[idx] >= now:
+                return idx
+            idx -= 1
+        return None
+
+    def next(self, endDate):
+        """
+        @return: index of the first program starting at or after endDate, or None
+        """
+        idx = bisect.bisect_left(self.startDates, endDate)
+        while idx < len(self.startDates) and self.endDates[idx] < endDate:
+            idx += 1
+        if idx < len(self.startDates):
+            return idx
+        return None
+
+    def previous(self, startDate):
+        """
+        @return: index of the last program ending at or before startDate, or None
+        """
+        idx = bisect.bisect_right(self.startDates, startDate) - 1
+        while idx >= 0 and self.endDates[idx] > startDate:
+            idx -= 1
+        if idx >= 0:
+            return idx
+        return None
+
+class ChannelFilter(object):
+    """
+    The channels whose programs are read by a source with CHANNEL_FILTER set, either the channels with the given
+    ids or all channels but those. Programs of other channels are skipped before a Program is created.
+    """
+    def __init__(self, channelIds, exclude):
+        """
+        @param channelIds: ids of the channels to read, or to skip if exclude is set
+        @param exclude: read all channels except channelIds
+        """
+        self.channelIds = frozenset(channelIds)
+        self.exclude = exclude
+
+    def accepts(self, channelId):
+        return (channelId in self.channelIds) != self.exclude
+
 class SourceException(Exception):
     pass
 
@@ -111,46 +199,452 @@ class MyHTMLParser(HTMLParser):
     def get_fileids(self):
         return self.link
 
+class DatabaseWriterRequest(object):
+    def __init__(self, function, args, transactional = True):
+        """
+        A change submitted to DatabaseWriter, completed once the change has been committed.
+
+        @param function: called on the writer thread with a cursor followed by args
+        @param args: additional arguments for function
+        @param transactional: run function inside the writer transaction, otherwise it runs on its own
+        """
+        self.function = function
+        self.args = args
+        self.transactional = transactional
+        self.value = None
+        self.excInfo = None
+        self.callbacks = list()
+        self.event = threading.Event()
+        self.lock = threading.Lock()
+
+    def done(self):
+        return self.event.isSet()
+
+    def result(self, timeout = None):
+        """
+        Wait for the change to be committed.
+        Exceptions raised by the function, or by the commit, are raised again here.
+
+        @param timeout: number of seconds to wait, waits until the change is complete if None
+        @return: the value returned by the function
+        """
+        self.event.wait(timeout)
+        if not self.event.isSet():
+            raise SourceException('Timed out waiting for database change')
+        if self.excInfo is not None:
+            raise self.excInfo[0], self.excInfo[1], self.excInfo[2]
+        return self.value
+
+    def addDoneCallback(self, callback):
+        """
+        Call callback with this request once it is complete. The callback is made from the writer thread,
+        or right away if the request is already complete.
+        """
+        self.lock.acquire()
+        try:
+            if not self.event.isSet():
+                self.callbacks.append(callback)
+                return
+        finally:
+            self.lock.release()
+        self._call(callback)
+
+    def _complete(self, value, excInfo):
+        self.lock.acquire()
+        try:
+            self.value = value
+            self.excInfo = excInfo
+            self.event.set()
+            callbacks = self.callbacks
+            self.callbacks = list()
+        finally:
+            self.lock.release()
+
+        for callback in callbacks:
+            self._call(callback)
+
+    def _call(self, callback):
+        try:
+            callback(self)
+        except Exception, ex:
+            xbmc.log('[script.tvguide] Database change callback failed: %s' % str(ex), xbmc.LOGERROR)
+
+class DatabaseWriter(threading.Thread):
+    """
+    Makes all changes to the database from a single thread, so callers never wait for a lock or a disk write.
+
+    Changes are queued with submit(..) and run in order, each in a savepoint of its own so a failing change
+    doesn't affect the others. Changes submitted within COMMIT_DELAY seconds of each other share a commit.
+    """
+    COMMIT_DELAY = 0.05
+    MAX_REQUESTS_PER_COMMIT = 100
+
+    def __init__(self, conn):
+        super(DatabaseWriter, self).__init__(name = 'DatabaseWriter')
+        self.daemon = True
+        self.conn = conn
+        self.conn.isolation_level = None # transactions are managed by the writer
+        self.queue = Queue.Queue()
+
+    def submit(self, function, *args):
+        """
+        Queue a change to the database.
+
+        @param function: called on the writer thread with a cursor followed by args, must not commit
+        @return: a DatabaseWriterRequest
+        @rtype: DatabaseWriterRequest
+        """
+        request = DatabaseWriterRequest(function, args)
+        self.queue.put(request)
+        return request
+
+    def submitAutocommit(self, function, *args):
+        """
+        Like submit(..), but function runs outside of a transaction. Used for PRAGMAs that have no effect
+        inside a transaction.
+        """
+        request = DatabaseWriterRequest(function, args, transactional = False)
+        self.queue.put(request)
+        return request
+
+    def flush(self):
+        """
+        Wait until all changes submitted so far have been committed.
+        """
+        self.submit(lambda c: None).result()
+
+    def stop(self):
+        """
+        Commit the changes already submitted and stop the thread.
+        """
+        self.queue.put(None)
+        self.join()
+
+    def run(self):
+        request = self.queue.get()
+        while request is not None:
+            if request.transactional:
+                request = self._runTransaction(request)
+            else:
+                self._runAutocommit(request)
+                request = self.queue.get()
+
+    def _runAutocommit(self, request):
+        c = self.conn.cursor()
+        try:
+            value = request.function(c, *request.args)
+        except Exception:
+            request._complete(None, sys.exc_info())
+        else:
+            request._complete(value, None)
+        c.close()
+
+    def _runTransaction(self, request):
+        """
+        Run request, and the requests submitted shortly after it, in a single transaction.
+
+        @return: the next item from the queue, which is not part of the transaction
+        """
+        c = self.conn.cursor()
+        requests = list()
+        values = list()
+        following = None
+        hasFollowing = False
+        excInfo = None
+        try:
+            c.execute('BEGIN IMMEDIATE')
+            deadline = time.time() + self.COMMIT_DELAY
+            while True:
+                requests.append(request)
+                values.append(self._runInSavepoint(c, request))
+                if len(requests) >= self.MAX_REQUESTS_PER_COMMIT:
+                    break
+                try:
+                    request = self.queue.get(timeout = max(0, deadline - time.time()))
+                except Queue.Empty:
+                    break
+                if request is None or not request.transactional:
+                    following = request
+                    hasFollowing = True
+                    break
+            c.execute('COMMIT')
+
+        except sqlite3.Error:
+            excInfo = sys.exc_info()
+            try:
+                c.execute('ROLLBACK')
+            except sqlite3.Error:
+                pass # no transaction is active
+        c.close()
+
+        if excInfo is not None:
+            # nothing has been committed
+            for failedRequest in requests or [request]:
+                failedRequest._complete(None, excInfo)
+        else:
+            for completedRequest, (value, requestExcInfo) in zip(requests, values):
+                completedRequest._complete(value, requestExcInfo)
+
+        if hasFollowing:
+            return following
+        return self.queue.get()
+
+    def _runInSavepoint(self, c, request):
+        """
+        @return: tuple of the value returned by the request and the exception info if it failed
+        """
+        c.execute('SAVEPOINT request')
+        try:
+            value = request.function(c, *request.args)
+        except Exception:
+            excInfo = sys.exc_info()
+            c.execute('ROLLBACK TO request')
+            c.execute('RELEASE request')
+            return None, excInfo
+        c.execute('RELEASE request')
+        return value, None
+
+class SourceDataReader(threading.Thread):
+    """
+    Fetches and parses the data of a source on a thread of its own, so the source doesn't wait while the
+    importer fingerprints and stores what it has already read.
+
+    Items are handed over in chunks of CHUNK_SIZE through a queue holding at most queueSize chunks, the
+    reader waits when the importer falls behind. Exceptions raised while reading, including
+    SourceUpdateCanceledException, are raised again by the importer.
+    """
+    CHUNK_SIZE = 500
+    PUT_TIMEOUT = 0.5
+
+    def __init__(self, getData, queueSize):
+        """
+        @param getData: called on the reader thread, returns the data as a list or iterable
+        @param queueSize: number of chunks read ahead of the importer
+        """
+        super(SourceDataReader, self).__init__(name = 'SourceDataReader')
+        self.daemon = True
+        self.getData = getData
+        self.queue = Queue.Queue(queueSize)
+        self.stopped = False
+
+    def __iter__(self):
+        """
+        Yield the items read, in order.
+        """
+        while True:
+            (chunk, excInfo) = self.queue.get()
+            if excInfo is not None:
+                raise excInfo[0], excInfo[1], excInfo[2]
+            if chunk is None:
+                return
+            for item in chunk:
+                yield item
+
+    def stop(self):
+        """
+        Stop reading, used when the importer gives up before all items are read.
+        The reader closes the data on its own thread once a pending fetch returns.
+        """
+        self.stopped = True
+
+    def run(self):
+        data = None
+        try:
+            data = self.getData()
+            chunk = list()
+            for item in data:
+                chunk.append(item)
+                if len(chunk) >= self.CHUNK_SIZE:
+                    if not self._put(chunk, None):
+                        return
+                    chunk = list()
+            if self._put(chunk, None):
+                self._put(None, None)
+        except Exception:
+            self._put(None, sys.exc_info())
+        finally:
+            if hasattr(data, 'close'):
+                # runs the finally blocks of a generator that was stopped early
+                data.close()
+
+    def _put(self, chunk, excInfo):
+        """
+        @return: False if the importer stopped reading before there was room for the chunk
+        """
+        while not self.stopped:
+            try:
+                self.queue.put((chunk, excInfo), timeout = self.PUT_TIMEOUT)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+class NowAndNextUpdater(threading.Thread):
+    """
+    Keeps the current and next programs of Source.getNowAndNext(..) up to date. One thread sleeps until the
+    first of them changes and reads the channels whose programs changed, so it only keeps one read connection.
+    """
+    def __init__(self, refresh):
+        """
+        @param refresh: called on the updater thread when the programs change, schedules the next change again
+        """
+        super(NowAndNextUpdater, self).__init__(name = 'NowAndNextUpdater')
+        self.daemon = True
+        self.refresh = refresh
+        self.condition = threading.Condition()
+        self.validUntil = None
+        self.stopped = False
+
+    def schedule(self, validUntil):
+        """
+        @param validUntil: time the first of the programs changes, or None when there are no programs to keep up to date
+        """
+        self.condition.acquire()
+        try:
+            self.validUntil = validUntil
+            self.condition.notify()
+        finally:
+            self.condition.release()
+
+    def stop(self):
+        """
+        Stop the thread and wait for a refresh in progress to finish.
+        """
+        self.condition.acquire()
+        try:
+            self.stopped = True
+            self.condition.notify()
+        finally:
+            self.condition.release()
+        self.join()
+
+    def run(self):
+        self.condition.acquire()
+        try:
+            while not self.stopped:
+                if self.validUntil is None:
+                    self.condition.wait()
+                elif time.time() < self.validUntil:
+                    self.condition.wait(self.validUntil - time.time())
+                else:
+                    self.validUntil = None
+                    # refresh without the condition, schedule(..) is called by the refresh and by other threads
+                    self.condition.release()
+                    try:
+                        self.refresh()
+                    except Exception, ex:
+                        xbmc.log('[script.tvguide] Unable to update current and next programs: %s' % str(ex), xbmc.LOGERROR)
+                    finally:
+                        self.condition.acquire()
+        finally:
+            self.condition.release()
+
 class Source(object):
     KEY = "undefined"
     SOURCE_DB = 'source.db'
+    PROGRAM_BATCH_SIZE = 5000
+    BULK_LOAD_BATCH_SIZE = 50000
+    BULK_LOAD_CACHE_SIZE = 20000
+    # chunks of items read ahead of the importer, see SourceDataReader
+    IMPORT_READ_AHEAD = 20
+    # batches handed to the database writer before the importer waits for the oldest one
+    IMPORT_PENDING_BATCHES = 1
+    # ids of titles and image url prefixes remembered by an import, see _internText(..)
+    IMPORT_TEXT_CACHE_SIZE = 5000
+    # getDataFromExternal(..) accepts a ChannelFilter, programs of hidden channels are then not imported
+    # until the channel is made visible, see backfillChannels(..)
+    CHANNEL_FILTER = False
+    PROGRAM_INDEXES = [
+        ('program_list_idx', '(source, channel, end_date, start_date)'),
+        ('start_date_idx', '(start_date)'),
+        ('end_date_idx', '(end_date)')
+    ]
+    # columns and tables for reading programs with their interned texts resolved, see _insertPrograms(..)
+    PROGRAM_COLUMNS = 'p.channel, t.text AS title, p.start_date, p.end_date, d.text AS description, ' \
+        'il.text || p.image_large AS image_large, ism.text || p.image_small AS image_small'
+    PROGRAM_TABLES = 'programs p LEFT JOIN texts t ON t.id=p.title_id LEFT JOIN texts d ON d.id=p.description_id ' \
+        'LEFT JOIN texts il ON il.id=p.image_large_prefix_id LEFT JOIN texts ism ON ism.id=p.image_small_prefix_id'
+    # getProgramList(..) only reads what the guide needs to lay out a page, see getProgramDetails(..)
+    PROGRAM_LIST_COLUMNS = 'p.rowid AS id, p.channel, t.text AS title, p.start_date, p.end_date'
+    PROGRAM_LIST_TABLES = 'programs p LEFT JOIN texts t ON t.id=p.title_id'
+    # getProgramList(..) binds channel ids in multiples of this, so most pages share one statement
+    PROGRAM_LIST_CHANNEL_SLOTS = 10
+    # getProgramList(..) only searches the R*Tree once the longest program exceeds this many seconds
+    INTERVAL_INDEX_LONGEST_PROGRAM = 12 * 3600
+    # find the current, next and previous program of a channel in memory, see _getProgramTimeline(..)
+    PROGRAM_TIMELINES = True
+    # the now/next cache reads programs this many seconds ahead, see getNowAndNext(..)
+    NOW_NEXT_WINDOW = 6 * 3600
+    # number of pages kept by getProgramList(..), the least recently used page is dropped first
+    PROGRAM_LIST_CACHE_SIZE = 32
+    # number of programs kept by getProgramDetails(..)
+    PROGRAM_DETAILS_CACHE_SIZE = 50
+    # seconds after which the import lock of an import that stopped refreshing it is taken over, see _claimImportLock(..)
+    IMPORT_LOCK_TIMEOUT = 600
 
     def __init__(self, addon, cachePath):
         self.cachePath = cachePath
         self.updateInProgress = False
+        # identifies the imports of this instance in import_lock, unique among running processes
+        self.importLockOwner = '%d-%d' % (os.getpid(), id(self))
         buggalo.addExtraData('source', self.KEY)
         for key in SETTINGS_TO_CHECK:
             buggalo.addExtraData('setting: %s' % key, ADDON.getSetting(key))
 
         self.channelList = list()
+        self.channelPositions = (None, dict())
+        self.programTimelines = dict()
+        self.nowAndNext = None
+        self.nowAndNextLock = threading.Lock()
+        self.nowAndNextUpdater = None
+        self.programListCache = dict()
+        self.programDetailsCache = dict()
+        self.programListCacheLock = threading.Lock()
+        self.programListCacheTick = 0
+        self.programListCacheGeneration = 0
         self.player = xbmc.Player()
         self.osdEnabled = addon.getSetting('enable.osd') == 'true'
-
-        databasePath = os.path.join(self.cachePath, self.SOURCE_DB)
+        # keep an R*Tree of program times when SQLite has the R*Tree module, see _createIntervalIndex(..)
+        # it makes imports slower, so it's an advanced setting for sources with programs lasting days
+        self.intervalIndexEnabled = addon.getSetting('index.program.times') == 'true'
+
+        self.databasePath = os.path.join(self.cachePath, self.SOURCE_DB)
+        self.readConnections = list()
+        self.readConnectionsLock = threading.Lock()
+        self.threadLocal = threading.local()
+        self.conn = None
+        self.writer = None
+        self.intervalIndex = False
         for retries in range(0, 3):
             try:
-                self.conn = sqlite3.connect(databasePath, detect_types=sqlite3.PARSE_DECLTYPES, check_same_thread = False)
+                self.conn = sqlite3.connect(self.databasePath, detect_types=sqlite3.PARSE_DECLTYPES, check_same_thread = False)
+                # with write-ahead logging readers don't block the writer and the writer doesn't block readers
+                self.conn.execute('PRAGMA journal_mode = WAL')
+                self.conn.execute('PRAGMA synchronous = NORMAL')
                 self.conn.execute('PRAGMA foreign_keys = ON')
                 self.conn.row_factory = sqlite3.Row
 
-                # create and drop dummy table to check if database is locked
-                c = self.conn.cursor()
-                c.execute('CREATE TABLE database_lock_check(id TEXT PRIMARY KEY)')
-                c.execute('DROP TABLE database_lock_check')
-                c.close()
+                # from here on all changes are made by the writer thread
+                self.writer = DatabaseWriter(self.conn)
+                self.writer.start()
 
-                self._createTables()
+                self.writer.submit(self._createTables).result()
+                # an import by another process doesn't keep this one from reading, with write-ahead logging and
+                # staging tables readers see the programs of the last finished import
+                self.intervalIndex = self.writer.submit(self._createIntervalIndex).result()
                 self.settingsChanged = self.wasSettingsChanged(addon)
                 break
 
             except sqlite3.OperationalError, ex:
+                self._closeDatabase()
                 raise SourceUpdateInProgressException(ex)
             except sqlite3.DatabaseError:
-                self.conn = None
-                try:
-                    os.unlink(databasePath)
-                except OSError:
-                    pass
+                self._closeDatabase()
+                for path in [self.databasePath, self.databasePath + '-wal', self.databasePath + '-shm']:
+                    try:
+                        os.unlink(path)
+                    except OSError:
+                        pass
                 xbmcgui.Dialog().ok(ADDON.getAddonInfo('name'), strings(DATABASE_SCHEMA_ERROR_1),
                     strings(DATABASE_SCHEMA_ERROR_2), strings(DATABASE_SCHEMA_ERROR_3))
 
@@ -158,24 +652,92 @@ class Source(object):
             raise SourceNotConfiguredException()
 
     def close(self):
-        #self.conn.rollback() # rollback any non-commit'ed changes to avoid database lock
+        """
+        Commit the changes already submitted, stop the writer thread and close all connections.
+        """
         if self.player.isPlaying():
             self.player.stop()
-        self.conn.close()
+        self.nowAndNextLock.acquire()
+        try:
+            # the stopped updater is kept, so a refresh still in progress doesn't start another one
+            updater = self.nowAndNextUpdater
+            self.nowAndNext = None
+        finally:
+            self.nowAndNextLock.release()
+        if updater is not None:
+            updater.stop()
+        if self.writer is not None:
+            self.writer.flush()
+            self.writer.stop()
+            self.writer = None
+        self.readConnectionsLock.acquire()
+        try:
+            for thread, conn in self.readConnections:
+                conn.close()
+            del self.readConnections[:]
+        finally:
+            self.readConnectionsLock.release()
+        self._closeDatabase()
+
+    def _closeDatabase(self):
+        """
+        Stop the writer thread once the submitted changes are committed, and close the connection.
+        """
+        if self.writer is not None:
+            self.writer.stop()
+            self.writer = None
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def getReadConnection(self):
+        """
+        Returns a read-only connection for the calling thread.
+        All changes are made by self.writer, reading through a separate connection per thread
+        means reads never wait for an import or another thread.
+        """
+        conn = getattr(self.threadLocal, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.databasePath, detect_types=sqlite3.PARSE_DECLTYPES, check_same_thread = False)
+            conn.execute('PRAGMA query_only = ON')
+            conn.row_factory = sqlite3.Row
+            self.threadLocal.conn = conn
+
+            self.readConnectionsLock.acquire()
+            try:
+                # close connections left behind by threads that have finished
+                for thread, threadConn in self.readConnections[:]:
+                    if not thread.isAlive():
+                        threadConn.close()
+                        self.readConnections.remove((thread, threadConn))
+                self.readConnections.append((threading.currentThread(), conn))
+            finally:
+                self.readConnectionsLock.release()
+
+        return conn
 
     def wasSettingsChanged(self, addon):
+        settings = dict()
+        for key in SETTINGS_TO_CHECK:
+            settings[key] = addon.getSetting(key)
+
+        settingsChanged = self.writer.submit(self._updateSettings, settings).result()
+        print 'Settings changed: ' + str(settingsChanged)
+        #return True # Uncomment to force cache regeneration every run, for debug prp only
+        return settingsChanged
+
+    def _updateSettings(self, c, settings):
         settingsChanged = False
         noRows = True
         count = 0
 
-        c = self.conn.cursor()
         c.execute('SELECT * FROM settings')
         for row in c:
             noRows = False
             key = row['key']
             if SETTINGS_TO_CHECK.count(key):
                 count += 1
-                if row['value'] != addon.getSetting(key):
+                if row['value'] != settings[key]:
                     settingsChanged = True
 
         if count != len(SETTINGS_TO_CHECK):
@@ -183,15 +745,11 @@ class Source(object):
 
         if settingsChanged or noRows:
             for key in SETTINGS_TO_CHECK:
-                value = addon.getSetting(key).decode('utf-8', 'ignore')
+                value = settings[key].decode('utf-8', 'ignore')
                 c.execute('INSERT OR IGNORE INTO settings(key, value) VALUES (?, ?)', [key, value])
                 if not c.rowcount:
                     c.execute('UPDATE settings SET value=? WHERE key=?', [value, key])
-            self.conn.commit()
 
-        c.close()
-        print 'Settings changed: ' + str(settingsChanged)
-        #return True # Uncomment to force cache regeneration every run, for debug prp only
         return settingsChanged
 
     def getDataFromExternal(self, date, progress_callback = None):
@@ -199,6 +757,9 @@ class Source(object):
         Retrieve data from external as a list or iterable. Data may contain both Channel and Program objects.
         The source may choose to ignore the date parameter and return all data available.
 
+        Sources with CHANNEL_FILTER set take a third parameter channelFilter, a ChannelFilter of the channels
+        to return programs for, or None for all channels. All channels are returned either way.
+
         @param date: the date to retrieve the data for
         @param progress_callback:
         @return:
@@ -208,68 +769,145 @@ class Source(object):
     def isCacheExpired(self, date = datetime.datetime.now()):
         return self.settingsChanged or self._isChannelListCacheExpired() or self._isProgramListCacheExpired(date)
 
-    def updateChannelAndProgramListCaches(self, date = datetime.datetime.now(), progress_callback = None, clearExistingProgramList = True):
+    def updateChannelAndProgramListCaches(self, date = datetime.datetime.now(), progress_callback = None, clearExistingProgramList = True, batchSize = None):
+        """
+        Import channels and programs from getDataFromExternal(..) into the database.
+
+        When the previous import of the same programs stored channel fingerprints, the import is incremental:
+        programs are written to a temporary table and a fingerprint of each channel's programs is compared with
+        the stored one. Only channels whose programs changed are rewritten. Otherwise the data is written to the
+        staging tables channels_new and programs_new, which replace channels and programs when the import is
+        complete. Either way the changes are applied in one short transaction at the end, until then the
+        existing data is left untouched and can still be used by the guide.
+
+        The import runs as a pipeline: a SourceDataReader fetches and parses the data while this thread
+        fingerprints the programs read so far, and the database writer stores the batches before those.
+        Programs are written in batches of batchSize rows using executemany, at most IMPORT_PENDING_BATCHES
+        batches wait for the writer before the import waits for the oldest one to be committed.
+        The indexes on programs_new are built once all programs have been inserted.
+
+        When clearExistingProgramList is set the import runs as a bulk load: durability is relaxed and each
+        batch is inserted sorted by channel and start date.
+
+        Sources with CHANNEL_FILTER set skip the programs of hidden channels, unless the settings changed which
+        makes all channels visible again. The channels are still imported, and their programs are imported by
+        backfillChannels(..) once they are made visible.
+
+        @param date: the date to retrieve the data for
+        @param progress_callback: called with the percentage complete and the number of programs imported per second
+        @param clearExistingProgramList: delete programs for all dates and not only for date
+        @param batchSize: number of programs per batch, defaults to PROGRAM_BATCH_SIZE
+        """
+        bulkLoad = clearExistingProgramList
+        if batchSize is None:
+            if bulkLoad:
+                batchSize = self.BULK_LOAD_BATCH_SIZE
+            else:
+                batchSize = self.PROGRAM_BATCH_SIZE
         self.updateInProgress = True
         dateStr = date.strftime('%Y-%m-%d')
-        c = self.conn.cursor()
+        settingsChanged = self.settingsChanged
+        pragmas = None
+        updatesId = None
+        updatesCreated = False
+        reader = None
+        importLocked = False
         try:
             xbmc.log('[script.tvguide] Updating caches...', xbmc.LOGDEBUG)
             if progress_callback:
                 progress_callback(0)
 
-            if self.settingsChanged:
-                c.execute('DELETE FROM channels WHERE source=?', [self.KEY])
-                c.execute('DELETE FROM programs WHERE source=?', [self.KEY])
-                c.execute("DELETE FROM updates WHERE source=?", [self.KEY])
+            # the staging tables are shared by all processes using the database, only one may import at a time
+            self.writer.submit(self._claimImportLock).result()
+            importLocked = True
+            pragmas = self.writer.submitAutocommit(self._beginImport, bulkLoad).result()
+            (updatesId, incremental, updatesCreated) = self.writer.submit(self._prepareImport, dateStr, settingsChanged, clearExistingProgramList).result()
             self.settingsChanged = False # only want to update once due to changed settings
-
-            if clearExistingProgramList:
-                c.execute("DELETE FROM updates WHERE source=?", [self.KEY]) # cascades and deletes associated programs records
+            if incremental:
+                table = 'programs_import'
             else:
-                c.execute("DELETE FROM updates WHERE source=? AND date=?", [self.KEY, dateStr]) # cascades and deletes associated programs records
+                table = 'programs_new'
+
+            channelFilter = None
+            if self.CHANNEL_FILTER and not settingsChanged:
+                hiddenChannels = self._retrieveHiddenChannelIds()
+                if hiddenChannels:
+                    channelFilter = ChannelFilter(hiddenChannels, True)
+                    xbmc.log('[script.tvguide] Skipping programs of %d hidden channels' % len(hiddenChannels), xbmc.LOGDEBUG)
+
+            imported_channels = imported_programs = 0
+            channels = list()
+            programs = list()
+            fingerprints = dict()
+            pendingBatches = list()
+            texts = dict()
+            importStarted = time.time()
+
+            def batchProgressCallback(percentageComplete):
+                return progress_callback(percentageComplete, self._programsPerSecond(imported_programs, importStarted))
 
-            # programs updated
-            c.execute("INSERT INTO updates(source, date, programs_updated) VALUES(?, ?, ?)", [self.KEY, dateStr, datetime.datetime.now()])
-            updatesId = c.lastrowid
-
-            imported = imported_channels = imported_programs = 0
-            for item in self.getDataFromExternal(date, progress_callback):
-                imported += 1
+            if progress_callback:
+                externalProgressCallback = batchProgressCallback
+            else:
+                externalProgressCallback = None
 
-                if imported % 10000 == 0:
-                    self.conn.commit()
+            def getData():
+                if channelFilter is not None:
+                    return self.getDataFromExternal(date, externalProgressCallback, channelFilter)
+                return self.getDataFromExternal(date, externalProgressCallback)
 
+            reader = SourceDataReader(getData, self.IMPORT_READ_AHEAD)
+            reader.start()
+            for item in reader:
                 if isinstance(item, Channel):
                     imported_channels += 1
-                    channel = item
-                    c.execute('INSERT OR IGNORE INTO channels(id, title, logo, stream_url, visible, weight, source) VALUES(?, ?, ?, ?, ?, (CASE ? WHEN -1 THEN (SELECT COALESCE(MAX(weight)+1, 0) FROM channels WHERE source=?) ELSE ? END), ?)', [channel.id, channel.title, channel.logo, channel.streamUrl, channel.visible, channel.weight, self.KEY, channel.weight, self.KEY])
-                    if not c.rowcount:
-                        c.execute('UPDATE channels SET title=?, logo=?, stream_url=?, visible=(CASE ? WHEN -1 THEN visible ELSE ? END), weight=(CASE ? WHEN -1 THEN weight ELSE ? END) WHERE id=? AND source=?',
-                            [channel.title, channel.logo, channel.streamUrl, channel.weight, channel.visible, channel.weight, channel.weight, channel.id, self.KEY])
+                    channels.append(item)
 
                 elif isinstance(item, Program):
                     imported_programs += 1
-                    program = item
-                    if isinstance(program.channel, Channel):
-                        channel = program.channel.id
-                    else:
-                        channel = program.channel
+                    row = self._programRow(item, updatesId)
+                    channel = row[0]
+                    if channel not in fingerprints:
+                        fingerprints[channel] = hashlib.md5()
+                    fingerprints[channel].update(repr(row[1:7]))
+
+                    programs.append(row)
+                    if len(programs) >= batchSize:
+                        pendingBatches.append(self.writer.submit(self._insertPrograms, table, programs, texts, bulkLoad))
+                        self.writer.submit(self._refreshImportLock)
+                        programs = list()
+                        while len(pendingBatches) > self.IMPORT_PENDING_BATCHES:
+                            pendingBatches.pop(0).result()
+
+            pendingBatches.append(self.writer.submit(self._insertPrograms, table, programs, texts, bulkLoad))
+            for batch in pendingBatches:
+                batch.result()
+
+            # with all channels hidden no programs are imported
+            if imported_channels == 0 or (imported_programs == 0 and channelFilter is None):
+                raise SourceException('No channels or programs imported')
 
-                    c.execute('INSERT INTO programs(channel, title, start_date, end_date, description, image_large, image_small, source, updates_id) VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?)',
-                        [channel, program.title, program.startDate, program.endDate, program.description, program.imageLarge, program.imageSmall, self.KEY, updatesId])
+            for channel, fingerprint in fingerprints.items():
+                fingerprints[channel] = fingerprint.hexdigest()
 
-            # channels updated
-            c.execute("UPDATE sources SET channels_updated=? WHERE id=?", [datetime.datetime.now(),self.KEY])
-            self.conn.commit()
+            if incremental:
+                (changedChannels, removedChannels) = self.writer.submit(self._applyChangedChannels, updatesId, dateStr, channels, fingerprints).result()
+                xbmc.log('[script.tvguide] Programs changed for %d of %d channels, %d channels removed'
+                         % (changedChannels, len(fingerprints), removedChannels), xbmc.LOGDEBUG)
+            else:
+                self.writer.submit(self._swapStagingTables, updatesId, None if clearExistingProgramList else dateStr, channels, fingerprints).result()
+            self.clearImportedData()
 
-            if imported_channels == 0 or imported_programs == 0:
-                raise SourceException('No channels or programs imported')
+            xbmc.log('[script.tvguide] Imported %d channels and %d programs (%d programs/s)'
+                     % (imported_channels, imported_programs, self._programsPerSecond(imported_programs, importStarted)), xbmc.LOGDEBUG)
+
+        except SourceUpdateInProgressException:
+            # another process is importing, nothing has been changed
+            raise
 
         except SourceUpdateCanceledException:
-            # force source update on next load
-            c.execute('UPDATE sources SET channels_updated=? WHERE id=?', [datetime.datetime.fromtimestamp(0), self.KEY])
-            c.execute("DELETE FROM updates WHERE source=?", [self.KEY]) # cascades and deletes associated programs records
-            self.conn.commit()
+            # force source update on next load, existing data is kept until then
+            self.writer.submit(self._abortImport, updatesId if updatesCreated else None).result()
 
         except Exception, ex:
             import traceback as tb
@@ -277,25 +915,531 @@ class Source(object):
             (type, value, traceback) = sys.exc_info()
             tb.print_exception(type, value, traceback)
 
-            try:
-                self.conn.rollback()
-            except sqlite3.OperationalError:
-                pass # no transaction is active
-
             try:
                 # invalidate cached data
-                c.execute('UPDATE sources SET channels_updated=? WHERE id=?', [datetime.datetime.fromtimestamp(0), self.KEY])
-                self.conn.commit()
+                self.writer.submit(self._abortImport, updatesId if updatesCreated else None).result()
             except sqlite3.OperationalError:
                 pass # database is locked
 
             raise SourceException(ex)
         finally:
+            if reader is not None:
+                reader.stop()
+            if importLocked:
+                try:
+                    self.writer.submitAutocommit(self._endImport, pragmas).result()
+                except sqlite3.OperationalError, ex:
+                    xbmc.log('[script.tvguide] Unable to clean up after import: %s' % str(ex), xbmc.LOGERROR)
+                self._releaseImportLock()
+            self.updateInProgress = False
+
+    def backfillChannels(self, channels, progress_callback = None):
+        """
+        Import the programs of channels that were skipped by the last import because they were hidden, see
+        CHANNEL_FILTER. Only the programs of these channels are read and written, with their fingerprints,
+        so the next import leaves them alone unless they changed.
+
+        Channels with a fingerprint from the last import already have their programs and are not read again.
+
+        @param channels: the channels made visible
+        @param progress_callback: called with the percentage complete, returns False to cancel
+        @return: the number of programs imported
+        """
+        if not self.CHANNEL_FILTER or not channels:
+            return 0
+
+        self.updateInProgress = True
+        importLocked = False
+        try:
+            self.writer.submit(self._claimImportLock).result()
+            importLocked = True
+            (updatesId, channelIds) = self.writer.submit(self._prepareBackfill, [channel.id for channel in channels]).result()
+            if not channelIds:
+                return 0
+
+            xbmc.log('[script.tvguide] Importing programs of %d channels made visible' % len(channelIds), xbmc.LOGDEBUG)
+            programs = list()
+            fingerprints = dict()
+            for item in self.getDataFromExternal(datetime.datetime.now(), progress_callback, ChannelFilter(channelIds, False)):
+                if isinstance(item, Program):
+                    row = self._programRow(item, updatesId)
+                    if row[0] not in fingerprints:
+                        fingerprints[row[0]] = hashlib.md5()
+                    fingerprints[row[0]].update(repr(row[1:7]))
+                    programs.append(row)
+
+            for channel, fingerprint in fingerprints.items():
+                fingerprints[channel] = fingerprint.hexdigest()
+            self.writer.submit(self._applyBackfill, updatesId, programs, fingerprints).result()
+
+            for channelId in channelIds:
+                self.programTimelines.pop(channelId, None)
+            self._invalidateNowAndNext()
+            self.clearProgramListCache()
+            xbmc.log('[script.tvguide] Imported %d programs for %d channels' % (len(programs), len(fingerprints)), xbmc.LOGDEBUG)
+            return len(programs)
+
+        except SourceUpdateCanceledException:
+            # the channels are imported with all visible channels by the next import
+            return 0
+
+        except Exception, ex:
+            import traceback as tb
+            import sys
+            (type, value, traceback) = sys.exc_info()
+            tb.print_exception(type, value, traceback)
+            raise SourceException(ex)
+        finally:
+            if importLocked:
+                self._releaseImportLock()
             self.updateInProgress = False
+
+    def isImportInProgress(self):
+        """
+        @return: True while an import of another process, or another instance, holds the import lock
+        """
+        c = self.getReadConnection().cursor()
+        try:
+            self._checkImportLock(c)
+        except SourceUpdateInProgressException:
+            return True
+        finally:
             c.close()
+        return False
+
+    def clearImportedData(self):
+        """
+        Drop the channels and programs kept in memory, called once an import is complete, also when it was
+        made by another process.
+        """
+        self.channelList = None
+        # rowids of programs are changed by an import
+        self.programTimelines = dict()
+        self._invalidateNowAndNext()
+        self.clearProgramListCache()
+
+    def _claimImportLock(self, c):
+        """
+        Claim the import lock for this instance. Runs in a writer transaction, which starts with BEGIN IMMEDIATE,
+        so two processes can't both find the lock free.
+
+        @raise SourceUpdateInProgressException: if another process, or another instance, holds the lock
+        """
+        self._checkImportLock(c)
+        c.execute('INSERT OR REPLACE INTO import_lock(id, owner, locked) VALUES(0, ?, ?)', [self.importLockOwner, int(time.time())])
+
+    def _checkImportLock(self, c):
+        """
+        @raise SourceUpdateInProgressException: if an import of another instance holds the lock
+        """
+        c.execute('SELECT owner, locked FROM import_lock WHERE id=0')
+        row = c.fetchone()
+        if row is not None and row['owner'] != self.importLockOwner and row['locked'] > time.time() - self.IMPORT_LOCK_TIMEOUT:
+            raise SourceUpdateInProgressException('Import in progress by %s' % row['owner'])
+
+    def _refreshImportLock(self, c):
+        c.execute('UPDATE import_lock SET locked=? WHERE id=0 AND owner=?', [int(time.time()), self.importLockOwner])
+
+    def _releaseImportLock(self):
+        try:
+            self.writer.submit(self._deleteImportLock).result()
+        except sqlite3.OperationalError, ex:
+            xbmc.log('[script.tvguide] Unable to release import lock: %s' % str(ex), xbmc.LOGERROR)
+
+    def _deleteImportLock(self, c):
+        c.execute('DELETE FROM import_lock WHERE id=0 AND owner=?', [self.importLockOwner])
+
+    def _prepareBackfill(self, c, channelIds):
+        """
+        @return: tuple of the id of the record in updates of the last import, or None, and the ids of the channels
+            without a fingerprint from that import
+        """
+        c.execute('SELECT MAX(id) FROM updates WHERE source=?', [self.KEY])
+        updatesId = c.fetchone()[0]
+        if updatesId is None:
+            return None, list()
+
+        c.execute('SELECT channel FROM channel_fingerprints WHERE updates_id=?', [updatesId])
+        fingerprinted = set([row['channel'] for row in c.fetchall()])
+        return updatesId, [channelId for channelId in channelIds if channelId not in fingerprinted]
+
+    def _applyBackfill(self, c, updatesId, programs, fingerprints):
+        """
+        Replace the programs of the backfilled channels, an import may have written them in the meantime.
+
+        @param fingerprints: dict of channel id to fingerprint of the programs imported for the channel
+        """
+        c.executemany('DELETE FROM programs WHERE source=? AND channel=? AND updates_id=?', [(self.KEY, channel, updatesId) for channel in fingerprints])
+        self._insertPrograms(c, 'programs', programs, dict(), True)
+        c.executemany('INSERT OR REPLACE INTO channel_fingerprints(updates_id, channel, fingerprint) VALUES(?, ?, ?)',
+            [(updatesId, channel, fingerprint) for channel, fingerprint in fingerprints.items()])
+        self._updateLongestProgram(c)
+
+    def _retrieveHiddenChannelIds(self):
+        c = self.getReadConnection().cursor()
+        c.execute('SELECT id FROM channels WHERE source=? AND visible=?', [self.KEY, False])
+        channelIds = [row['id'] for row in c]
+        c.close()
+        return channelIds
+
+    def _programRow(self, program, updatesId):
+        """
+        @return: tuple of the columns of program written by _insertPrograms(..), the fingerprint of a channel
+            is the md5 of repr(row[1:7]) of each of its programs in turn
+        """
+        if isinstance(program.channel, Channel):
+            channel = program.channel.id
+        else:
+            channel = program.channel
+        return (channel, program.title, toEpoch(program.startDate), toEpoch(program.endDate), program.description, program.imageLarge, program.imageSmall, self.KEY, updatesId)
+
+    def _beginImport(self, c, bulkLoad):
+        """
+        Runs outside of a transaction, foreign keys can't be switched off inside one.
+
+        @return: the PRAGMAs changed for a bulk load, or None
+        """
+        # the staging tables reference channels and updates, foreign keys are checked by hand in _swapStagingTables(..)
+        c.execute('PRAGMA foreign_keys = OFF')
+        if bulkLoad:
+            return self._beginBulkLoad(c)
+        return None
+
+    def _endImport(self, c, pragmas):
+        self._dropStagingTables(c)
+        c.execute('PRAGMA foreign_keys = ON')
+        if pragmas is not None:
+            self._endBulkLoad(c, pragmas)
+
+    def _prepareImport(self, c, dateStr, settingsChanged, clearExistingProgramList):
+        """
+        Choose between an incremental import and a full import through the staging tables.
+
+        An incremental import needs the fingerprints stored with the single record in updates it replaces,
+        or a date without a record in updates when only programs for that date are replaced.
+
+        @return: tuple of the id of the record in updates used by the import, True if the import is incremental
+            and True if the record in updates was created for the import
+        """
+        if not settingsChanged:
+            if clearExistingProgramList:
+                c.execute('SELECT id FROM updates WHERE source=?', [self.KEY])
+            else:
+                c.execute('SELECT id FROM updates WHERE source=? AND date=?', [self.KEY, dateStr])
+            rows = c.fetchall()
+
+            if len(rows) == 1:
+                c.execute('SELECT 1 FROM channel_fingerprints WHERE updates_id=? LIMIT 1', [rows[0]['id']])
+                if c.fetchone():
+                    self._createImportTable(c)
+                    return rows[0]['id'], True, False
+
+            elif not rows and not clearExistingProgramList:
+                self._createImportTable(c)
+                c.execute("INSERT INTO updates(source, date, programs_updated) VALUES(?, ?, ?)", [self.KEY, dateStr, datetime.datetime.now()])
+                return c.lastrowid, True, True
+
+        return self._prepareStagingTables(c, dateStr, settingsChanged, clearExistingProgramList), False, True
+
+    def _prepareStagingTables(self, c, dateStr, settingsChanged, clearExistingProgramList):
+        """
+        Create the staging tables with the data kept by this import.
+
+        @return: id of the new record in updates
+        """
+        self._createStagingTables(c)
+        c.execute('INSERT INTO channels_new SELECT * FROM channels')
+        if settingsChanged:
+            c.execute('DELETE FROM channels_new WHERE source=?', [self.KEY])
+
+        if settingsChanged or clearExistingProgramList:
+            c.execute('INSERT INTO programs_new SELECT * FROM programs WHERE source<>?', [self.KEY])
+        else:
+            c.execute('INSERT INTO programs_new SELECT * FROM programs WHERE source<>? OR updates_id NOT IN (SELECT id FROM updates WHERE source=? AND date=?)',
+                [self.KEY, self.KEY, dateStr])
+
+        # programs updated
+        c.execute("INSERT INTO updates(source, date, programs_updated) VALUES(?, ?, ?)", [self.KEY, dateStr, datetime.datetime.now()])
+        return c.lastrowid
+
+    def _abortImport(self, c, updatesId):
+        """
+        @param updatesId: the record in updates created for the import, or None if an existing record was used
+        """
+        c.execute('UPDATE sources SET channels_updated=? WHERE id=?', [datetime.datetime.fromtimestamp(0), self.KEY])
+        if updatesId is not None:
+            c.execute("DELETE FROM updates WHERE id=?", [updatesId])
+
+    def _insertChannels(self, c, table, channels):
+        for channel in channels:
+            c.execute('INSERT OR IGNORE INTO %s(id, title, logo, stream_url, visible, weight, source) VALUES(?, ?, ?, ?, ?, (CASE ? WHEN -1 THEN (SELECT COALESCE(MAX(weight)+1, 0) FROM %s WHERE source=?) ELSE ? END), ?)' % (table, table),
+                [channel.id, channel.title, channel.logo, channel.streamUrl, channel.visible, channel.weight, self.KEY, channel.weight, self.KEY])
+            if not c.rowcount:
+                c.execute('UPDATE %s SET title=?, logo=?, stream_url=?, visible=(CASE ? WHEN -1 THEN visible ELSE ? END), weight=(CASE ? WHEN -1 THEN weight ELSE ? END) WHERE id=? AND source=?' % table,
+                    [channel.title, channel.logo, channel.streamUrl, channel.weight, channel.visible, channel.weight, channel.weight, channel.id, self.KEY])
+
+    def _insertPrograms(self, c, table, programs, texts, sort = False):
+        """
+        Insert a batch of programs into programs_new or programs_import.
+
+        Titles, descriptions and the part of image urls up to the last slash are stored once in texts and
+        referenced by id. Missing descriptions are stored as NULL. Descriptions are rarely repeated, so only
+        the ids of titles and image url prefixes are remembered.
+
+        @param c: cursor of the writer connection
+        @param table: name of the table
+        @param programs: list of tuples of channel, title, start date, end date, description, large image, small image,
+            source and updates id
+        @param texts: dict of text to id of the texts used by the import so far, see _internText(..)
+        @param sort: insert the programs ordered by channel and start date
+        """
+        if sort:
+            programs.sort(key = lambda row: (row[0], row[2]))
+
+        rows = list()
+        for channel, title, startDate, endDate, description, imageLarge, imageSmall, source, updatesId in programs:
+            imageLargePrefix, imageLarge = self._splitImageUrl(imageLarge)
+            imageSmallPrefix, imageSmall = self._splitImageUrl(imageSmall)
+            rows.append((channel, self._internText(c, texts, title), startDate, endDate, self._internText(c, None, description),
+                         self._internText(c, texts, imageLargePrefix), imageLarge, self._internText(c, texts, imageSmallPrefix), imageSmall,
+                         source, updatesId))
+
+        c.executemany('INSERT INTO %s(channel, title_id, start_date, end_date, description_id, image_large_prefix_id, image_large, image_small_prefix_id, image_small, source, updates_id) VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)' % table, rows)
+
+    def _internText(self, c, texts, text):
+        """
+        Texts are found through texts_idx. Only the import holding the import lock adds texts, and unused texts
+        are deleted at its end, so the ids can be kept in memory for the duration of the import.
+
+        @param texts: dict of text to id, emptied once it holds IMPORT_TEXT_CACHE_SIZE texts, or None
+        @return: id of the text in texts
+        """
+        if text is None:
+            return None
+        if texts is not None:
+            id = texts.get(text)
+            if id is not None:
+                return id
+
+        c.execute('SELECT id FROM texts WHERE text=?', [text])
+        row = c.fetchone()
+        if row is not None:
+            id = row[0]
+        else:
+            c.execute('INSERT INTO texts(text) VALUES(?)', [text])
+            id = c.lastrowid
+
+        if texts is not None:
+            if len(texts) >= self.IMPORT_TEXT_CACHE_SIZE:
+                texts.clear()
+            texts[text] = id
+        return id
+
+    def _splitImageUrl(self, url):
+        """
+        @return: tuple of the url up to and including the last slash, and the rest of the url
+        """
+        if url is None:
+            return None, None
+        idx = url.rfind('/') + 1
+        return url[:idx], url[idx:]
+
+    def _updateLongestProgram(self, c):
+        """
+        Store the duration of the longest program of this source, it bounds the search in getProgramList(..)
+        """
+        c.execute('UPDATE sources SET longest_program=(SELECT COALESCE(MAX(end_date - start_date), 0) FROM programs WHERE source=?) WHERE id=?', [self.KEY, self.KEY])
+
+    def _deleteUnusedTexts(self, c):
+        c.execute('DELETE FROM texts WHERE id NOT IN (SELECT title_id FROM programs WHERE title_id IS NOT NULL UNION SELECT description_id FROM programs WHERE description_id IS NOT NULL '
+                  'UNION SELECT image_large_prefix_id FROM programs WHERE image_large_prefix_id IS NOT NULL '
+                  'UNION SELECT image_small_prefix_id FROM programs WHERE image_small_prefix_id IS NOT NULL)')
+
+    def _applyChangedChannels(self, c, updatesId, dateStr, channels, fingerprints):
+        """
+        Rewrite the programs of the channels whose fingerprint differs from the one stored by the previous import,
+        and delete the programs of channels that are no longer included.
+
+        @param fingerprints: dict of channel id to fingerprint of the programs imported for the channel
+        @return: tuple of the number of changed and removed channels
+        """
+        self._insertChannels(c, 'channels', channels)
+
+        c.execute('SELECT channel, fingerprint FROM channel_fingerprints WHERE updates_id=?', [updatesId])
+        storedFingerprints = dict([(row['channel'], row['fingerprint']) for row in c.fetchall()])
+        changedChannels = [channel for channel in fingerprints if storedFingerprints.get(channel) != fingerprints[channel]]
+        removedChannels = [channel for channel in storedFingerprints if channel not in fingerprints]
+
+        c.execute('CREATE INDEX temp.programs_import_idx ON programs_import(channel)')
+        for channel in changedChannels + removedChannels:
+            c.execute('DELETE FROM programs WHERE source=? AND channel=? AND updates_id=?', [self.KEY, channel, updatesId])
+        for channel in changedChannels:
+            c.execute('INSERT INTO programs SELECT * FROM programs_import WHERE channel=?', [channel])
+
+        c.executemany('INSERT OR REPLACE INTO channel_fingerprints(updates_id, channel, fingerprint) VALUES(?, ?, ?)',
+            [(updatesId, channel, fingerprints[channel]) for channel in changedChannels])
+        c.executemany('DELETE FROM channel_fingerprints WHERE updates_id=? AND channel=?', [(updatesId, channel) for channel in removedChannels])
+        if changedChannels or removedChannels:
+            self._deleteUnusedTexts(c)
+            self._updateLongestProgram(c)
+
+        c.execute('UPDATE updates SET date=?, programs_updated=? WHERE id=?', [dateStr, datetime.datetime.now(), updatesId])
+        # channels updated
+        c.execute("UPDATE sources SET channels_updated=? WHERE id=?", [datetime.datetime.now(), self.KEY])
+
+        return len(changedChannels), len(removedChannels)
+
+    def _programsPerSecond(self, programCount, startTime):
+        elapsed = time.time() - startTime
+        if elapsed <= 0:
+            return 0
+        return programCount / elapsed
+
+    def _createStagingTables(self, c):
+        """
+        Create empty channels_new and programs_new tables with the same definition as channels and programs.
+        The staging tables have no indexes, these are created when the import is complete.
+        """
+        self._dropStagingTables(c)
+        for table in ['channels', 'programs']:
+            self._createTableLike(c, table, 'CREATE TABLE %s_new' % table)
+
+    def _createImportTable(self, c):
+        """
+        Create the temporary table programs_import with the same definition as programs.
+        Being temporary, its content is not written to the database file.
+        """
+        self._dropStagingTables(c)
+        self._createTableLike(c, 'programs', 'CREATE TEMP TABLE programs_import')
+
+    def _createTableLike(self, c, table, createTable):
+        c.execute("SELECT sql FROM sqlite_master WHERE type='table' AND name=?", [table])
+        sql = c.fetchone()[0]
+        # the table name is quoted once the table has been renamed
+        c.execute(re.sub(r'^CREATE TABLE\s+"?%s"?' % table, createTable, sql))
+
+    def _dropStagingTables(self, c):
+        c.execute('DROP TABLE IF EXISTS channels_new')
+        c.execute('DROP TABLE IF EXISTS programs_new')
+        c.execute('DROP TABLE IF EXISTS temp.programs_import')
+
+    def _stagingIndexSuffix(self, c):
+        """
+        Index names are shared by all tables, so programs_new can't use the index names of programs.
+        Two sets of index names are used in turn, this returns the suffix of the set not used by programs.
+        """
+        c.execute("SELECT 1 FROM sqlite_master WHERE type='index' AND tbl_name='programs' AND name=?", [self.PROGRAM_INDEXES[0][0]])
+        if c.fetchone():
+            return '_swap'
+        else:
+            return ''
+
+    def _swapStagingTables(self, c, updatesId, dateStr, channels, fingerprints):
+        """
+        Build the indexes of programs_new, then replace programs with programs_new and the content of channels
+        with channels_new. This runs as a single change on the writer thread, so it is committed as a whole.
+        Update records replaced by updatesId are deleted, either all for this source or only those for dateStr.
+
+        @param channels: list of imported Channel objects
+        @param fingerprints: dict of channel id to fingerprint of the programs imported for the channel
+        """
+        self._insertChannels(c, 'channels_new', channels)
+        self._createProgramIndexes(c, 'programs_new', self._stagingIndexSuffix(c))
+        c.execute('ANALYZE programs_new')
+
+        c.execute('DROP TABLE programs')
+        c.execute('ALTER TABLE programs_new RENAME TO programs')
+        # statistics are looked up by index name, keep them with the renamed table
+        c.execute("UPDATE sqlite_stat1 SET tbl='programs' WHERE tbl='programs_new'")
+        if self.intervalIndex:
+            self._createIntervalIndex(c, rebuild = True)
+
+        c.execute('DELETE FROM channels')
+        c.execute('INSERT INTO channels SELECT * FROM channels_new')
+        c.execute('DROP TABLE channels_new')
+        c.execute('DELETE FROM notifications WHERE NOT EXISTS (SELECT 1 FROM channels WHERE channels.id=notifications.channel AND channels.source=notifications.source)')
+
+        if dateStr is None:
+            c.execute('DELETE FROM updates WHERE source=? AND id<>?', [self.KEY, updatesId])
+        else:
+            c.execute('DELETE FROM updates WHERE source=? AND date=? AND id<>?', [self.KEY, dateStr, updatesId])
+        c.execute('DELETE FROM channel_fingerprints WHERE updates_id NOT IN (SELECT id FROM updates)')
+        self._deleteUnusedTexts(c)
+        self._updateLongestProgram(c)
+        c.executemany('INSERT INTO channel_fingerprints(updates_id, channel, fingerprint) VALUES(?, ?, ?)',
+            [(updatesId, channel, fingerprint) for channel, fingerprint in fingerprints.items()])
+
+        # channels updated
+        c.execute("UPDATE sources SET channels_updated=? WHERE id=?", [datetime.datetime.now(), self.KEY])
+
+    def _beginBulkLoad(self, c):
+        """
+        Relax durability for the duration of a bulk load.
+
+        @return: the previous values of the changed PRAGMAs, to be passed on to _endBulkLoad(..)
+        """
+        pragmas = dict()
+        for pragma in ['synchronous', 'cache_size', 'temp_store']:
+            c.execute('PRAGMA %s' % pragma)
+            pragmas[pragma] = c.fetchone()[0]
+
+        c.execute('PRAGMA synchronous = OFF')
+        c.execute('PRAGMA cache_size = %d' % self.BULK_LOAD_CACHE_SIZE)
+        c.execute('PRAGMA temp_store = MEMORY')
+
+        return pragmas
+
+    def _endBulkLoad(self, c, pragmas):
+        """
+        Restore the PRAGMAs changed by _beginBulkLoad(..)
+        """
+        for pragma, value in pragmas.items():
+            c.execute('PRAGMA %s = %d' % (pragma, value))
+
+    def _createProgramIndexes(self, c, table = 'programs', suffix = ''):
+        for name, columns in self.PROGRAM_INDEXES:
+            c.execute('CREATE INDEX IF NOT EXISTS %s%s ON %s%s' % (name, suffix, table, columns))
+
+    def _createIntervalIndex(self, c, rebuild = False):
+        """
+        Create the R*Tree program_intervals over the start and end dates of programs, keyed by the rowid of
+        the program. Triggers on programs keep it up to date, so only replacing programs requires a rebuild.
+        The R*Tree module is optional in SQLite, without it program_intervals is not used.
+
+        R*Tree coordinates are 32 bit floats, rounded outwards. A search of program_intervals can therefore
+        match programs just outside the searched time range, the dates in programs must be checked as well.
+
+        @param rebuild: fill program_intervals again from programs, which was replaced
+        @return: True if program_intervals exists
+        """
+        if not self.intervalIndexEnabled:
+            # switched off in the settings, the triggers would still slow down imports
+            c.execute('DROP TRIGGER IF EXISTS program_intervals_insert')
+            c.execute('DROP TRIGGER IF EXISTS program_intervals_delete')
+            c.execute('DROP TABLE IF EXISTS program_intervals')
+            return False
+
+        c.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='program_intervals'")
+        if not c.fetchone():
+            try:
+                c.execute('CREATE VIRTUAL TABLE program_intervals USING rtree(id, start_date, end_date)')
+            except sqlite3.OperationalError, ex:
+                xbmc.log('[script.tvguide] Program times are not indexed by an R*Tree: %s' % str(ex), xbmc.LOGDEBUG)
+                return False
+            rebuild = True
+
+        if rebuild:
+            c.execute('DELETE FROM program_intervals')
+            c.execute('INSERT INTO program_intervals(id, start_date, end_date) SELECT rowid, start_date, end_date FROM programs')
+
+        c.execute('CREATE TRIGGER IF NOT EXISTS program_intervals_insert AFTER INSERT ON programs BEGIN '
+                  'INSERT INTO program_intervals(id, start_date, end_date) VALUES(new.rowid, new.start_date, new.end_date); END')
+        c.execute('CREATE TRIGGER IF NOT EXISTS program_intervals_delete AFTER DELETE ON programs BEGIN '
+                  'DELETE FROM program_intervals WHERE id=old.rowid; END')
+        return True
 
     def getChannel(self, id):
-        c = self.conn.cursor()
+        c = self.getReadConnection().cursor()
         c.execute('SELECT * FROM channels WHERE source=? AND id=?', [self.KEY, id])
         row = c.fetchone()
         channel = Channel(row['id'], row['title'],row['logo'], row['stream_url'], row['visible'], row['weight'])
@@ -303,9 +1447,22 @@ class Source(object):
 
         return channel
 
+    def _getChannelPosition(self, channels, channel):
+        """
+        @param channels: the list returned by getChannelList()
+        @return: index of channel in channels
+        """
+        positions = self.channelPositions
+        if positions[0] is not channels:
+            # the channel list has been replaced, index the new one
+            positions = self.channelPositions = (channels, dict([(c.id, idx) for idx, c in enumerate(channels)]))
+        if channel.id not in positions[1]:
+            raise ValueError('%s is not in the channel list' % channel.id)
+        return positions[1][channel.id]
+
     def getNextChannel(self, currentChannel):
         channels = self.getChannelList()
-        idx = channels.index(currentChannel)
+        idx = self._getChannelPosition(channels, currentChannel)
         idx += 1
         if idx > len(channels) - 1:
             idx = 0
@@ -313,7 +1470,7 @@ class Source(object):
 
     def getPreviousChannel(self, currentChannel):
         channels = self.getChannelList()
-        idx = channels.index(currentChannel)
+        idx = self._getChannelPosition(channels, currentChannel)
         idx -= 1
         if idx < 0:
             idx = len(channels) - 1
@@ -327,18 +1484,26 @@ class Source(object):
         return self.channelList
 
     def _storeChannelListInDatabase(self, channelList):
-        c = self.conn.cursor()
+        """
+        @return: the DatabaseWriterRequest storing the channels
+        """
+        request = self.writer.submit(self._storeChannels, channelList)
+        # used until the next import, the change may not be committed yet
+        self.channelList = [channel for channel in sorted(channelList, key = lambda channel: channel.weight) if channel.visible]
+        self._invalidateNowAndNext()
+        self.clearProgramListCache()
+        return request
+
+    def _storeChannels(self, c, channelList):
         for idx, channel in enumerate(channelList):
             c.execute('INSERT OR IGNORE INTO channels(id, title, logo, stream_url, visible, weight, source) VALUES(?, ?, ?, ?, ?, (CASE ? WHEN -1 THEN (SELECT COALESCE(MAX(weight)+1, 0) FROM channels WHERE source=?) ELSE ? END), ?)', [channel.id, channel.title, channel.logo, channel.streamUrl, channel.visible, channel.weight, self.KEY, channel.weight, self.KEY])
             if not c.rowcount:
                 c.execute('UPDATE channels SET title=?, logo=?, stream_url=?, visible=?, weight=(CASE ? WHEN -1 THEN weight ELSE ? END) WHERE id=? AND source=?', [channel.title, channel.logo, channel.streamUrl, channel.visible, channel.weight, channel.weight, channel.id, self.KEY])
 
         c.execute("UPDATE sources SET channels_updated=? WHERE id=?", [datetime.datetime.now(), self.KEY])
-        self.channelList = None
-        self.conn.commit()
 
     def _retrieveChannelListFromDatabase(self, onlyVisible = True):
-        c = self.conn.cursor()
+        c = self.getReadConnection().cursor()
         channelList = list()
         if onlyVisible:
             c.execute('SELECT * FROM channels WHERE source=? AND visible=? ORDER BY weight', [self.KEY, True])
@@ -352,7 +1517,7 @@ class Source(object):
 
     def _isChannelListCacheExpired(self):
         try:
-            c = self.conn.cursor()
+            c = self.getReadConnection().cursor()
             c.execute('SELECT channels_updated FROM sources WHERE id=?', [self.KEY])
             row = c.fetchone()
             if not row:
@@ -372,10 +1537,114 @@ class Source(object):
         @type channel: source.Channel
         @return:
         """
+        return self.getNowAndNext(channel)[0]
+
+    def getNowAndNext(self, channel):
+        """
+        The current and next programs of all visible channels are kept until they change, a NowAndNextUpdater
+        then reads those of the channels whose programs changed. Hidden channels are read one by one.
+
+        @type channel: source.Channel
+        @return: tuple of the current and the next Program of the channel, either may be None, programs of visible
+            channels have no description or images, see getProgramDetails(..)
+        """
+        nowAndNext = self.nowAndNext
+        if nowAndNext is None or int(time.time()) >= nowAndNext[0]:
+            nowAndNext = self._refreshNowAndNext()
+        entry = nowAndNext[1].get(channel.id)
+        if entry is not None and int(time.time()) < entry[2]:
+            return entry[0], entry[1]
+
+        program = self._readCurrentProgram(channel)
+        if program is not None:
+            return program, self.getNextProgram(program)
+        return None, None
+
+    def _refreshNowAndNext(self):
+        """
+        Read the current and next programs of the visible channels that changed since the last refresh, and
+        schedule the NowAndNextUpdater for when the first of them changes again: at the end of a current program,
+        or the start of a next program on a channel with no current program. A next program starting more than
+        NOW_NEXT_WINDOW ahead is not found.
+
+        @return: tuple of the time the first programs change and a dict of channel id to a tuple of the current
+            and next Program and the time they change
+        """
+        self.nowAndNextLock.acquire()
+        try:
+            now = int(time.time())
+            channels = self.getChannelList()
+            previous = self.nowAndNext[1] if self.nowAndNext is not None else dict()
+            changedChannels = [channel for channel in channels if channel.id not in previous or now >= previous[channel.id][2]]
+
+            programs = dict()
+            # read past the page cache, in chunks the size of a page, binding every channel at once fails with
+            # too many SQL variables for large sources
+            for idx in range(0, len(changedChannels), self.PROGRAM_LIST_CHANNEL_SLOTS):
+                chunk = changedChannels[idx:idx + self.PROGRAM_LIST_CHANNEL_SLOTS]
+                for program in self._readProgramList(chunk, now, now + self.NOW_NEXT_WINDOW):
+                    programs.setdefault(program.channel.id, list()).append(program)
+
+            nowAndNext = dict()
+            for channel in channels:
+                if channel.id in previous and now < previous[channel.id][2]:
+                    nowAndNext[channel.id] = previous[channel.id]
+                    continue
+
+                channelPrograms = sorted(programs.get(channel.id, []), key = lambda program: program.startDate)
+                currentProgram = nextProgram = None
+                for program in channelPrograms:
+                    # at the end of a program the one starting then is the current one
+                    if program.startDate <= now <= program.endDate:
+                        currentProgram = program
+                for program in channelPrograms:
+                    if program is not currentProgram and program.startDate >= (currentProgram.endDate if currentProgram else now):
+                        nextProgram = program
+                        break
+
+                if nextProgram is not None and (currentProgram is None or nextProgram.startDate == currentProgram.endDate):
+                    validUntil = nextProgram.startDate
+                elif currentProgram is not None:
+                    validUntil = currentProgram.endDate + 1
+                else:
+                    validUntil = now + self.NOW_NEXT_WINDOW
+                nowAndNext[channel.id] = (currentProgram, nextProgram, validUntil)
+
+            validUntil = min([entry[2] for entry in nowAndNext.values()] + [now + self.NOW_NEXT_WINDOW])
+            self.nowAndNext = (validUntil, nowAndNext)
+            if self.nowAndNextUpdater is None:
+                self.nowAndNextUpdater = NowAndNextUpdater(self._refreshNowAndNext)
+                self.nowAndNextUpdater.start()
+            self.nowAndNextUpdater.schedule(validUntil)
+            return self.nowAndNext
+        finally:
+            self.nowAndNextLock.release()
+
+    def _invalidateNowAndNext(self):
+        """
+        Drop the current and next programs, they are read again when next used.
+        """
+        self.nowAndNextLock.acquire()
+        try:
+            self.nowAndNext = None
+            if self.nowAndNextUpdater is not None:
+                self.nowAndNextUpdater.schedule(None)
+        finally:
+            self.nowAndNextLock.release()
+
+    def _readCurrentProgram(self, channel):
         program = None
-        now = datetime.datetime.now()
-        c = self.conn.cursor()
-        c.execute('SELECT * FROM programs WHERE channel=? AND source=? AND start_date <= ? AND end_date >= ?', [channel.id, self.KEY, now, now])
+        now = int(time.time())
+        timeline = self._getProgramTimeline(channel)
+        if timeline is not None:
+            idx = timeline.current(now)
+            if idx is not None:
+                program = self._getProgramFromTimeline(channel, timeline, idx)
+            if program is not None or idx is None:
+                return program
+
+        c = self.getReadConnection().cursor()
+        c.execute('SELECT ' + self.PROGRAM_COLUMNS + ' FROM ' + self.PROGRAM_TABLES + ' WHERE p.channel=? AND p.source=? AND p.start_date <= ? AND p.end_date >= ?', [channel.id, self.KEY, now, now])
         row = c.fetchone()
         if row:
             program = Program(channel, row['title'], row['start_date'], row['end_date'], row['description'], row['image_large'], row['image_small'])
@@ -384,9 +1653,24 @@ class Source(object):
         return program
 
     def getNextProgram(self, program):
+        nowAndNext = self.nowAndNext
+        if nowAndNext is not None and program.channel.id in nowAndNext[1]:
+            (currentProgram, nextProgram, validUntil) = nowAndNext[1][program.channel.id]
+            if currentProgram is not None and nextProgram is not None and currentProgram.startDate == program.startDate:
+                return nextProgram
+
         nextProgram = None
-        c = self.conn.cursor()
-        c.execute('SELECT * FROM programs WHERE channel=? AND source=? AND start_date >= ? ORDER BY start_date ASC LIMIT 1', [program.channel.id, self.KEY, program.endDate])
+        timeline = self._getProgramTimeline(program.channel)
+        if timeline is not None:
+            idx = timeline.next(program.endDate)
+            if idx is not None:
+                nextProgram = self._getProgramFromTimeline(program.channel, timeline, idx)
+            if nextProgram is not None or idx is None:
+                return nextProgram
+
+        c = self.getReadConnection().cursor()
+        # end_date >= ? is implied by start_date >= ?, it limits the search of program_list_idx to later programs
+        c.execute('SELECT ' + self.PROGRAM_COLUMNS + ' FROM ' + self.PROGRAM_TABLES + ' WHERE p.channel=? AND p.source=? AND p.end_date >= ? AND p.start_date >= ? ORDER BY p.start_date ASC LIMIT 1', [program.channel.id, self.KEY, program.endDate, program.endDate])
         row = c.fetchone()
         if row:
             nextProgram = Program(program.channel, row['title'], row['start_date'], row['end_date'], row['description'], row['image_large'], row['image_small'])
@@ -396,8 +1680,16 @@ class Source(object):
 
     def getPreviousProgram(self, program):
         previousProgram = None
-        c = self.conn.cursor()
-        c.execute('SELECT * FROM programs WHERE channel=? AND source=? AND end_date <= ? ORDER BY start_date DESC LIMIT 1', [program.channel.id, self.KEY, program.startDate])
+        timeline = self._getProgramTimeline(program.channel)
+        if timeline is not None:
+            idx = timeline.previous(program.startDate)
+            if idx is not None:
+                previousProgram = self._getProgramFromTimeline(program.channel, timeline, idx)
+            if previousProgram is not None or idx is None:
+                return previousProgram
+
+        c = self.getReadConnection().cursor()
+        c.execute('SELECT ' + self.PROGRAM_COLUMNS + ' FROM ' + self.PROGRAM_TABLES + ' WHERE p.channel=? AND p.source=? AND p.end_date <= ? ORDER BY p.start_date DESC LIMIT 1', [program.channel.id, self.KEY, program.startDate])
         row = c.fetchone()
         if row:
             previousProgram = Program(program.channel, row['title'], row['start_date'], row['end_date'], row['description'], row['image_large'], row['image_small'])
@@ -405,34 +1697,255 @@ class Source(object):
 
         return previousProgram
 
-    def getProgramList(self, channels, startTime):
+    def _getProgramTimeline(self, channel):
+        """
+        The timeline of a channel is loaded on first use and kept until the next import.
+
+        @type channel: source.Channel
+        @return: ProgramTimeline of the channel, or None if PROGRAM_TIMELINES is off
+        """
+        if not self.PROGRAM_TIMELINES:
+            return None
+        timelines = self.programTimelines
+        timeline = timelines.get(channel.id)
+        if timeline is None:
+            c = self.getReadConnection().cursor()
+            c.execute('SELECT rowid, start_date, end_date FROM programs WHERE source=? AND channel=? ORDER BY start_date', [self.KEY, channel.id])
+            timeline = timelines[channel.id] = ProgramTimeline(c.fetchall())
+            c.close()
+        return timeline
+
+    def _getProgramFromTimeline(self, channel, timeline, idx):
+        """
+        Read a program by its rowid. Another process may have imported programs since the timeline was loaded,
+        so the program must still have the start date of the timeline.
+
+        @return: the Program, or None if the timelines are out of date, they are then dropped
+        """
+        program = None
+        c = self.getReadConnection().cursor()
+        c.execute('SELECT ' + self.PROGRAM_COLUMNS + ' FROM ' + self.PROGRAM_TABLES + ' WHERE p.rowid=? AND p.source=? AND p.channel=? AND p.start_date=?',
+            [timeline.rowIds[idx], self.KEY, channel.id, timeline.startDates[idx]])
+        row = c.fetchone()
+        if row:
+            program = Program(channel, row['title'], row['start_date'], row['end_date'], row['description'], row['image_large'], row['image_small'])
+        else:
+            self.programTimelines = dict()
+        c.close()
+
+        return program
+
+    def getProgramList(self, channels, startTime, endTime = None):
         """
 
         @param channels:
         @type channels: list of source.Channel
         @param startTime:
         @type startTime: datetime.datetime
-        @return:
+        @param endTime: end of the time range, two hours after startTime if None
+        @return: list of Program without description and images, see getProgramDetails(..)
+        """
+        startTime = toEpoch(startTime)
+        if endTime is None:
+            endTime = startTime + 2 * 3600
+        else:
+            endTime = toEpoch(endTime)
+
+        key = (tuple([channel.id for channel in channels]), startTime, endTime)
+        programList = self._getCached(self.programListCache, key)
+        if programList is None:
+            generation = self.programListCacheGeneration
+            programList = self._readProgramList(channels, startTime, endTime)
+            self._addToCache(self.programListCache, self.PROGRAM_LIST_CACHE_SIZE, key, programList, generation)
+        return list(programList)
+
+    def getProgramDetails(self, program):
+        """
+        Programs of getProgramList(..) have no description or images, they are read when needed.
+        The details of the most recently used programs are cached.
+
+        @type program: source.Program
+        @return: a Program with description and images, or the program itself if it has no id
+        """
+        if program.id is None:
+            return program
+
+        # a program read before an import may have the rowid of another program now
+        key = (program.id, program.channel.id, program.startDate)
+        details = self._getCached(self.programDetailsCache, key)
+        if details is None:
+            generation = self.programListCacheGeneration
+            details = self._readProgramDetails(program)
+            if details is None:
+                return program
+            self._addToCache(self.programDetailsCache, self.PROGRAM_DETAILS_CACHE_SIZE, key, details, generation)
+
+        rowId, description, imageLarge, imageSmall = details
+        return Program(program.channel, program.title, program.startDate, program.endDate, description, imageLarge, imageSmall,
+                       program.notificationScheduled, rowId)
+
+    def _readProgramDetails(self, program):
+        """
+        The rowid of a program changes when programs are imported again, so the program must still have the same
+        channel and start date, or it's looked up by those.
+
+        @return: tuple of rowid, description, large and small image, or None if the program no longer exists
+        """
+        c = self.getReadConnection().cursor()
+        c.execute('SELECT p.rowid AS id, ' + self.PROGRAM_COLUMNS + ' FROM ' + self.PROGRAM_TABLES + ' WHERE p.rowid=? AND p.source=? AND p.channel=? AND p.start_date=?',
+                  [program.id, self.KEY, program.channel.id, program.startDate])
+        row = c.fetchone()
+        if row is None:
+            c.execute('SELECT p.rowid AS id, ' + self.PROGRAM_COLUMNS + ' FROM ' + self.PROGRAM_TABLES + ' WHERE p.source=? AND p.channel=? AND p.start_date=?',
+                      [self.KEY, program.channel.id, program.startDate])
+            row = c.fetchone()
+        c.close()
+
+        if row is None:
+            return None
+        return row['id'], row['description'], row['image_large'], row['image_small']
+
+    def _getCached(self, cache, key):
+        """
+        @param cache: programListCache or programDetailsCache
+        @return: the cached value, or None
+        """
+        self.programListCacheLock.acquire()
+        try:
+            entry = cache.get(key)
+            if entry is None:
+                return None
+            self.programListCacheTick += 1
+            entry[0] = self.programListCacheTick
+            return entry[1]
+        finally:
+            self.programListCacheLock.release()
+
+    def _addToCache(self, cache, size, key, value, generation):
+        """
+        @param cache: programListCache or programDetailsCache, the least recently used entry is dropped once it holds
+            more than size entries
+        @param generation: value of programListCacheGeneration before the value was read, a value read before
+            the cache was cleared may be out of date and is not cached
+        """
+        self.programListCacheLock.acquire()
+        try:
+            if generation != self.programListCacheGeneration:
+                return
+            self.programListCacheTick += 1
+            cache[key] = [self.programListCacheTick, value]
+            if len(cache) > size:
+                leastRecentlyUsed = min(cache.items(), key = lambda item: item[1][0])[0]
+                del cache[leastRecentlyUsed]
+        finally:
+            self.programListCacheLock.release()
+
+    def clearProgramListCache(self):
+        """
+        Drop the pages cached by getProgramList(..) and the details cached by getProgramDetails(..), called when
+        programs, notifications or channels change.
         """
-        endTime = startTime + datetime.timedelta(hours = 2)
+        self.programListCacheLock.acquire()
+        try:
+            self.programListCache.clear()
+            self.programDetailsCache.clear()
+            self.programListCacheGeneration += 1
+        finally:
+            self.programListCacheLock.release()
+
+    def _readProgramList(self, channels, startTime, endTime):
         programList = list()
 
         channelMap = dict()
         for c in channels:
             channelMap[c.id] = c
+        if not channelMap:
+            return programList
 
-        c = self.conn.cursor()
-        c.execute('SELECT p.*, (SELECT 1 FROM notifications n WHERE n.channel=p.channel AND n.program_title=p.title AND n.source=p.source) AS notification_scheduled FROM programs p WHERE p.channel IN (\'' + ('\',\''.join(channelMap.keys())) + '\') AND p.source=? AND p.end_date >= ? AND p.start_date <= ?', [self.KEY, startTime, endTime])
+        # pad with a repeated id to a multiple of PROGRAM_LIST_CHANNEL_SLOTS, the query text then rarely changes
+        channelIds = channelMap.keys()
+        slots = -(-len(channelIds) // self.PROGRAM_LIST_CHANNEL_SLOTS) * self.PROGRAM_LIST_CHANNEL_SLOTS
+        channelIds += [channelIds[0]] * (slots - len(channelIds))
+
+        c = self.getReadConnection().cursor()
+        # notifications for the whole page are read in one go instead of being looked up for every program
+        c.execute('SELECT channel, program_title FROM notifications WHERE source=? AND channel IN (' + ', '.join(['?'] * slots) + ')', [self.KEY] + channelIds)
+        notifications = set(tuple(row) for row in c)
+
+        if self._useIntervalIndex(c, len(channelMap)):
+            c.execute(self._programListIntervalQuery(slots), [startTime, endTime, self.KEY] + channelIds + [startTime, endTime])
+        else:
+            c.execute(self._programListQuery(slots), [self.KEY] + channelIds + [startTime, endTime, self.KEY, endTime])
         for row in c:
-            program = Program(channelMap[row['channel']], row['title'], row['start_date'], row['end_date'], row['description'], row['image_large'], row['image_small'], row['notification_scheduled'])
+            notificationScheduled = (row['channel'], row['title']) in notifications
+            program = Program(channelMap[row['channel']], row['title'], row['start_date'], row['end_date'], None, notificationScheduled = notificationScheduled, id = row['id'])
             programList.append(program)
+        c.close()
 
         return programList
 
+    def _programListQuery(self, slots):
+        """
+        The programs are found in program_list_idx on source, channel and a range of end_date. The range ends
+        at the end of the time range plus the duration of the longest program, no program can end later and
+        still start in the time range. start_date is also part of the index, so programs are only read from
+        the table once they are known to be in the time range.
+
+        @param slots: number of channel ids bound to the query
+        """
+        return 'SELECT ' + self.PROGRAM_LIST_COLUMNS + ' FROM ' + self.PROGRAM_LIST_TABLES + ' WHERE p.source=? AND p.channel IN (' + ', '.join(['?'] * slots) + ') AND p.end_date >= ? ' \
+            'AND p.end_date <= ? + (SELECT longest_program FROM sources WHERE id=?) AND p.start_date <= ?'
+
+    def _programListIntervalQuery(self, slots):
+        """
+        The programs are found in program_intervals by time range, then filtered by channel.
+        The unary + keeps program_list_idx from being used for the channels.
+
+        @param slots: number of channel ids bound to the query
+        """
+        return 'SELECT ' + self.PROGRAM_LIST_COLUMNS + ' FROM ' + self.PROGRAM_LIST_TABLES + ' WHERE p.rowid IN ' \
+            '(SELECT id FROM program_intervals WHERE end_date >= ? AND start_date <= ?) ' \
+            'AND p.source=? AND +p.channel IN (' + ', '.join(['?'] * slots) + ') AND p.end_date >= ? AND p.start_date <= ?'
+
+    def _useIntervalIndex(self, c, channelCount):
+        """
+        program_list_idx is searched from the start of the time range to its end plus the longest program, for
+        every channel. With a very long program in the source that is a large part of the index. program_intervals
+        returns the programs of all channels in the time range instead, which pays off for a large part of the
+        channels only.
+
+        @param c: cursor of a read connection
+        @param channelCount: number of channels the programs are read for
+        """
+        if not self.intervalIndex or channelCount * 4 < len(self.getChannelList()):
+            return False
+        c.execute('SELECT longest_program FROM sources WHERE id=?', [self.KEY])
+        row = c.fetchone()
+        return row is not None and row['longest_program'] > self.INTERVAL_INDEX_LONGEST_PROGRAM
+
+    def _checkProgramListQueryPlan(self, c):
+        """
+        Log a warning if getProgramList(..) would not search program_list_idx, as that makes every page of the guide slow.
+        Not used by the addon, it's run by tests/test_queryplan.py and checkqueryplan.py after changes to the schema
+        or the query.
+
+        @param c: cursor of a connection to a database with the tables of _createTables(..)
+        @return: tuple of True if program_list_idx is searched and the query plan as a list of strings
+        """
+        slots = self.PROGRAM_LIST_CHANNEL_SLOTS
+        c.execute('EXPLAIN QUERY PLAN ' + self._programListQuery(slots), [self.KEY] + [''] * slots + [0, 0, self.KEY, 0])
+        plan = [row[-1] for row in c.fetchall()]
+
+        indexName = self.PROGRAM_INDEXES[0][0]
+        usesIndex = bool([detail for detail in plan if re.search(r'INDEX %s(_swap)? \(source=\? AND channel=\? AND end_date>\? AND end_date<\?\)' % indexName, detail)])
+        if not usesIndex:
+            xbmc.log('[script.tvguide] getProgramList is not using %s: %s' % (indexName, '; '.join(plan)), xbmc.LOGWARNING)
+        return usesIndex, plan
+
     def _isProgramListCacheExpired(self, date = datetime.datetime.now()):
         # check if data is up-to-date in database
         dateStr = date.strftime('%Y-%m-%d')
-        c = self.conn.cursor()
+        c = self.getReadConnection().cursor()
         c.execute('SELECT programs_updated FROM updates WHERE source=? AND date=?', [self.KEY, dateStr])
         row = c.fetchone()
         today = datetime.datetime.now()
@@ -449,14 +1962,17 @@ class Source(object):
         return content
 
     def setCustomStreamUrl(self, channel, stream_url):
-        c = self.conn.cursor()
-        c.execute("DELETE FROM custom_stream_url WHERE channel=?", [channel.id])
-        c.execute("INSERT INTO custom_stream_url(channel, stream_url) VALUES(?, ?)", [channel.id, stream_url.decode('utf-8', 'ignore')])
-        self.conn.commit()
-        c.close()
+        """
+        @return: the DatabaseWriterRequest storing the stream url
+        """
+        return self.writer.submit(self._setCustomStreamUrl, channel.id, stream_url.decode('utf-8', 'ignore'))
+
+    def _setCustomStreamUrl(self, c, channelId, stream_url):
+        c.execute("DELETE FROM custom_stream_url WHERE channel=?", [channelId])
+        c.execute("INSERT INTO custom_stream_url(channel, stream_url) VALUES(?, ?)", [channelId, stream_url])
 
     def getCustomStreamUrl(self, channel):
-        c = self.conn.cursor()
+        c = self.getReadConnection().cursor()
         c.execute("SELECT stream_url FROM custom_stream_url WHERE channel=?", [channel.id])
         stream_url = c.fetchone()
         c.close()
@@ -467,10 +1983,13 @@ class Source(object):
             return None
 
     def deleteCustomStreamUrl(self, channel):
-        c = self.conn.cursor()
-        c.execute("DELETE FROM custom_stream_url WHERE channel=?", [channel.id])
-        self.conn.commit()
-        c.close()
+        """
+        @return: the DatabaseWriterRequest deleting the stream url
+        """
+        return self.writer.submit(self._deleteCustomStreamUrl, channel.id)
+
+    def _deleteCustomStreamUrl(self, c, channelId):
+        c.execute("DELETE FROM custom_stream_url WHERE channel=?", [channelId])
 
     def isPlayable(self, channel):
         customStreamUrl = self.getCustomStreamUrl(channel)
@@ -487,6 +2006,8 @@ class Source(object):
 
     @buggalo.buggalo_try_except({'method' : 'source.playThread'})
     def playInThread(self, channel, playBackStoppedHandler):
+        # a stream url chosen just before may not have been committed yet
+        self.writer.flush()
         customStreamUrl = self.getCustomStreamUrl(channel)
         if customStreamUrl:
             customStreamUrl = customStreamUrl.encode('utf-8', 'ignore')
@@ -505,9 +2026,7 @@ class Source(object):
 
         playBackStoppedHandler.onPlayBackStopped()
 
-    def _createTables(self):
-        c = self.conn.cursor()
-
+    def _createTables(self, c):
         try:
             c.execute('SELECT major, minor, patch FROM version')
             (major, minor, patch) = c.fetchone()
@@ -543,16 +2062,90 @@ class Source(object):
                 c.execute('DROP TABLE programs')
                 c.execute('CREATE TABLE channels(id TEXT, title TEXT, logo TEXT, stream_url TEXT, source TEXT, visible BOOLEAN, weight INTEGER, PRIMARY KEY (id, source), FOREIGN KEY(source) REFERENCES sources(id) ON DELETE CASCADE DEFERRABLE INITIALLY DEFERRED)')
                 c.execute('CREATE TABLE programs(channel TEXT, title TEXT, start_date TIMESTAMP, end_date TIMESTAMP, description TEXT, image_large TEXT, image_small TEXT, source TEXT, updates_id INTEGER, FOREIGN KEY(channel, source) REFERENCES channels(id, source) ON DELETE CASCADE DEFERRABLE INITIALLY DEFERRED, FOREIGN KEY(updates_id) REFERENCES updates(id) ON DELETE CASCADE DEFERRABLE INITIALLY DEFERRED)')
-                c.execute('CREATE INDEX program_list_idx ON programs(source, channel, start_date, end_date)')
-                c.execute('CREATE INDEX start_date_idx ON programs(start_date)')
-                c.execute('CREATE INDEX end_date_idx ON programs(end_date)')
+                self._createProgramIndexes(c)
+
+            if version < [1, 3, 2]:
+                # For incremental updates
+                c.execute('UPDATE version SET major=1, minor=3, patch=2')
+                c.execute('CREATE TABLE channel_fingerprints(updates_id INTEGER, channel TEXT, fingerprint TEXT, PRIMARY KEY (updates_id, channel), FOREIGN KEY(updates_id) REFERENCES updates(id) ON DELETE CASCADE DEFERRABLE INITIALLY DEFERRED)')
+
+            if version < [1, 3, 3]:
+                # Store program times as seconds since the epoch (UTC) instead of TIMESTAMP strings in local time
+                c.execute('UPDATE version SET major=1, minor=3, patch=3')
+                c.execute('CREATE TABLE programs_new(channel TEXT, title TEXT, start_date INTEGER, end_date INTEGER, description TEXT, image_large TEXT, image_small TEXT, source TEXT, updates_id INTEGER, FOREIGN KEY(channel, source) REFERENCES channels(id, source) ON DELETE CASCADE DEFERRABLE INITIALLY DEFERRED, FOREIGN KEY(updates_id) REFERENCES updates(id) ON DELETE CASCADE DEFERRABLE INITIALLY DEFERRED)')
+                # programs left without channel or update record would fail the foreign key check on commit
+                c.execute("INSERT INTO programs_new SELECT channel, title, CAST(strftime('%s', start_date, 'utc') AS INTEGER), CAST(strftime('%s', end_date, 'utc') AS INTEGER), description, image_large, image_small, source, updates_id FROM programs p "
+                          "WHERE EXISTS (SELECT 1 FROM channels c WHERE c.id=p.channel AND c.source=p.source) AND EXISTS (SELECT 1 FROM updates u WHERE u.id=p.updates_id)")
+                c.execute('DROP TABLE programs')
+                c.execute('ALTER TABLE programs_new RENAME TO programs')
+                self._createProgramIndexes(c)
+                # fingerprints were made from the old representation
+                c.execute('DELETE FROM channel_fingerprints')
+
+            if version < [1, 3, 4]:
+                # Store titles, descriptions and image url prefixes once in texts, missing descriptions as NULL
+                c.execute('UPDATE version SET major=1, minor=3, patch=4')
+                c.execute('CREATE TABLE texts(id INTEGER PRIMARY KEY, text TEXT)')
+                c.execute('CREATE UNIQUE INDEX texts_idx ON texts(text)')
+                c.execute('CREATE TABLE programs_new(channel TEXT, title_id INTEGER, start_date INTEGER, end_date INTEGER, description_id INTEGER, image_large_prefix_id INTEGER, image_large TEXT, image_small_prefix_id INTEGER, image_small TEXT, source TEXT, updates_id INTEGER, FOREIGN KEY(channel, source) REFERENCES channels(id, source) ON DELETE CASCADE DEFERRABLE INITIALLY DEFERRED, FOREIGN KEY(updates_id) REFERENCES updates(id) ON DELETE CASCADE DEFERRABLE INITIALLY DEFERRED)')
+                noDescription = strings(NO_DESCRIPTION)
+                # read in batches on a cursor of its own, the programs may not fit in memory at once
+                read = c.connection.cursor()
+                read.execute('SELECT channel, title, start_date, end_date, description, image_large, image_small, source, updates_id FROM programs ORDER BY rowid')
+                texts = dict()
+                while True:
+                    programs = list()
+                    for row in read.fetchmany(self.PROGRAM_BATCH_SIZE):
+                        row = tuple(row)
+                        if row[4] == noDescription:
+                            row = row[:4] + (None, ) + row[5:]
+                        programs.append(row)
+                    if not programs:
+                        break
+                    self._insertPrograms(c, 'programs_new', programs, texts)
+                read.close()
+                c.execute('DROP TABLE programs')
+                c.execute('ALTER TABLE programs_new RENAME TO programs')
+                self._createProgramIndexes(c)
+                c.execute('DELETE FROM channel_fingerprints')
+
+            if version < [1, 3, 5]:
+                # Index end_date before start_date, getProgramList can then find programs by the end of the time range
+                c.execute('UPDATE version SET major=1, minor=3, patch=5')
+                for name, columns in self.PROGRAM_INDEXES:
+                    c.execute('DROP INDEX IF EXISTS %s' % name)
+                    c.execute('DROP INDEX IF EXISTS %s_swap' % name)
+                self._createProgramIndexes(c)
+                c.execute('ALTER TABLE sources ADD COLUMN longest_program INTEGER NOT NULL DEFAULT 0')
+                c.execute('UPDATE sources SET longest_program=(SELECT COALESCE(MAX(end_date - start_date), 0) FROM programs WHERE programs.source=sources.id)')
+
+            if version < [1, 3, 6]:
+                # Index notifications, a program can only have one
+                c.execute('UPDATE version SET major=1, minor=3, patch=6')
+                c.execute('DELETE FROM notifications WHERE rowid NOT IN (SELECT MIN(rowid) FROM notifications GROUP BY source, channel, program_title)')
+                c.execute('CREATE UNIQUE INDEX notifications_idx ON notifications(source, channel, program_title)')
+
+            if version < [1, 3, 7]:
+                # Only one process may import at a time, the staging tables are shared
+                c.execute('UPDATE version SET major=1, minor=3, patch=7')
+                c.execute('CREATE TABLE import_lock(id INTEGER PRIMARY KEY CHECK (id = 0), owner TEXT, locked INTEGER)')
+
+            if version < [1, 3, 8]:
+                # Find texts through an index instead of loading all of them for every import, concurrent imports
+                # of earlier versions may have stored a text twice
+                c.execute('UPDATE version SET major=1, minor=3, patch=8')
+                c.execute('CREATE TEMP TABLE duplicate_texts(id INTEGER PRIMARY KEY, first_id INTEGER)')
+                c.execute('INSERT INTO duplicate_texts(id, first_id) SELECT t.id, f.first_id FROM texts t '
+                          'JOIN (SELECT text, MIN(id) AS first_id FROM texts GROUP BY text) f ON f.text=t.text WHERE t.id<>f.first_id')
+                for column in ['title_id', 'description_id', 'image_large_prefix_id', 'image_small_prefix_id']:
+                    c.execute('UPDATE programs SET %s=(SELECT first_id FROM duplicate_texts WHERE id=%s) WHERE %s IN (SELECT id FROM duplicate_texts)' % (column, column, column))
+                c.execute('DELETE FROM texts WHERE id IN (SELECT id FROM duplicate_texts)')
+                c.execute('DROP TABLE duplicate_texts')
+                c.execute('CREATE UNIQUE INDEX IF NOT EXISTS texts_idx ON texts(text)')
 
             # make sure we have a record in sources for this Source
             c.execute("INSERT OR IGNORE INTO sources(id, channels_updated) VALUES(?, ?)", [self.KEY, datetime.datetime.fromtimestamp(0)])
 
-            self.conn.commit()
-            c.close()
-
         except sqlite3.OperationalError, ex:
             raise DatabaseSchemaException(ex)
 
@@ -578,7 +2171,7 @@ class DrDkSource(Source):
                 if program.has_key('ppu_description'):
                     description = program['ppu_description']
                 else:
-                    description = strings(NO_DESCRIPTION)
+                    description = None
 
                 p = Program(c, program['pro_title'], self._parseDate(program['pg_start']), self._parseDate(program['pg_stop']), description)
                 yield p
@@ -609,8 +2202,6 @@ class YouSeeTvSource(Source):
 
             for program in self.ysApi.programs(c.id, tvdate = date):
                 description = program['description']
-                if description is None:
-                    description = strings(NO_DESCRIPTION)
 
                 imagePrefix = program['imageprefix']
 
@@ -636,10 +2227,12 @@ class YouSeeTvSource(Source):
 
 class XMLTVSource(Source):
     KEY = 'xmltv'
+    CHANNEL_FILTER = True
 
     def __init__(self, addon, cachePath):
         super(XMLTVSource, self).__init__(addon, cachePath)
         self.logoFolder = addon.getSetting('xmltv.logo.folder')
+        self.parseProcesses = getXMLTVParseProcesses(addon)
         self.xmlTvFileLastChecked = datetime.datetime.fromtimestamp(0)
         self.xmltvFile = addon.getSetting('xmltv.file')
 
@@ -660,11 +2253,8 @@ class XMLTVSource(Source):
                 os.unlink(self.xmlTvFile)
             os.rename(tempFile, self.xmlTvFile)
 
-    def getDataFromExternal(self, date, progress_callback = None):
-        size = os.path.getsize(self.xmlTvFile)
-        f = open(self.xmlTvFile, "rb")
-        context = ElementTree.iterparse(f, events=("start", "end"))
-        return parseXMLTV(context, f, size, self.logoFolder, progress_callback)
+    def getDataFromExternal(self, date, progress_callback = None, channelFilter = None):
+        return parseXMLTVFile(self.xmlTvFile, self.logoFolder, progress_callback, self.parseProcesses, channelFilter)
 
     def _isChannelListCacheExpired(self):
         """
@@ -676,7 +2266,7 @@ class XMLTVSource(Source):
             return False
 
         try:
-            c = self.conn.cursor()
+            c = self.getReadConnection().cursor()
             c.execute('SELECT channels_updated FROM sources WHERE id=?', [self.KEY])
             row = c.fetchone()
             if not row:
@@ -694,6 +2284,7 @@ class XMLTVSource(Source):
 
 class XMLTVWEBSource(Source):
     KEY = 'xmltv-url'
+    CHANNEL_FILTER = True
 
     def __init__(self, addon, cachePath):
         
@@ -726,6 +2317,7 @@ class XMLTVWEBSource(Source):
         xbmc.log('[script.tvguide] Entering Init', xbmc.LOGDEBUG)        
         super(XMLTVWEBSource, self).__init__(addon, cachePath)
         self.logoFolder = addon.getSetting('xmltv.logo.folder')
+        self.parseProcesses = getXMLTVParseProcesses(addon)
         self.xmlTvFileLastChecked = datetime.datetime.fromtimestamp(0)
         self.HTMLURL = addon.getSetting('xmltv.url')
 
@@ -792,11 +2384,8 @@ class XMLTVWEBSource(Source):
 
     
             
-    def getDataFromExternal(self, date, progress_callback = None):
-        size = os.path.getsize(self.xmlTvFile)
-        f = open(self.xmlTvFile, "rb")
-        context = ElementTree.iterparse(f, events=("start", "end"))
-        return parseXMLTV(context, f, size, self.logoFolder, progress_callback)
+    def getDataFromExternal(self, date, progress_callback = None, channelFilter = None):
+        return parseXMLTVFile(self.xmlTvFile, self.logoFolder, progress_callback, self.parseProcesses, channelFilter)
 
     def _isChannelListCacheExpired(self):
         """
@@ -808,7 +2397,7 @@ class XMLTVWEBSource(Source):
             return False
 
         try:
-            c = self.conn.cursor()
+            c = self.getReadConnection().cursor()
             c.execute('SELECT channels_updated FROM sources WHERE id=?', [self.KEY])
             row = c.fetchone()
             if not row:
@@ -827,16 +2416,16 @@ class XMLTVWEBSource(Source):
         
 class ONTVSource(Source):
     KEY = 'ontv'
+    CHANNEL_FILTER = True
 
     def __init__(self, addon, cachePath):
         super(ONTVSource, self).__init__(addon, cachePath)
         self.ontvUrl = addon.getSetting('ontv.url')
 
-    def getDataFromExternal(self, date, progress_callback = None):
+    def getDataFromExternal(self, date, progress_callback = None, channelFilter = None):
         xml = self._downloadUrl(self.ontvUrl)
         io = StringIO.StringIO(xml)
-        context = ElementTree.iterparse(io)
-        return parseXMLTV(context, io, len(xml), None, progress_callback)
+        return parseXMLTV(io, len(xml), None, progress_callback, channelFilter)
 
     def _isProgramListCacheExpired(self, date = datetime.datetime.now()):
         return self._isChannelListCacheExpired()
@@ -902,7 +2491,7 @@ class JSONSource(Source):
                         if pr.has_key('d') and pr['d'] is not None: # program description
                             description = pr['d']
                         else:
-                            description = strings(NO_DESCRIPTION)
+                            description = None
 
                         if not pr.has_key('l'): # large program image
                             pr['l'] = None
@@ -931,57 +2520,421 @@ class JSONSource(Source):
     def _parseDate(self, dateString):
         return datetime.datetime.fromtimestamp(dateString)
 
+# number of timestamps remembered by parseXMLTVDate(..), a programme usually starts when the previous one stops
+# set to 0 to not remember timestamps, days and offsets are always remembered
+XMLTV_DATE_CACHE_SIZE = 20000
+# number of processes parsing an XMLTV file when not set in the advanced settings, see parseXMLTVFile(..)
+# worker processes are forked from XBMC, which not all platforms handle well, so this is off by default
+XMLTV_PARSE_PROCESSES = 1
+# an XMLTV file is split in this many byte ranges per process, results are returned a range at a time
+XMLTV_RANGES_PER_PROCESS = 4
+xmltvDateCache = dict()
+xmltvDayCache = dict()
+xmltvOffsetCache = dict()
+XMLTV_EPOCH_ORDINAL = datetime.date(1970, 1, 1).toordinal()
+
 def parseXMLTVDate(dateString):
-    if dateString is not None:
-        if dateString.find(' ') != -1:
-            # remove timezone information
-            dateString = dateString[:dateString.find(' ')]
-        t = time.strptime(dateString, '%Y%m%d%H%M%S')
-        return datetime.datetime(t.tm_year, t.tm_mon, t.tm_mday, t.tm_hour, t.tm_min, t.tm_sec)
+    """
+    Parse an XMLTV timestamp, such as 20121008201500 +0200. Seconds, minutes and hours may be left out.
+    A timestamp without a +HHMM or -HHMM offset is in local time.
+
+    @return: seconds since the epoch (UTC), or None
+    """
+    if dateString is None:
+        return None
+    epoch = xmltvDateCache.get(dateString)
+    if epoch is not None:
+        return epoch
+
+    date, separator, offset = dateString.strip().partition(' ')
+    if len(date) < 8 or not date.isdigit():
+        raise ValueError('Invalid XMLTV date: %s' % dateString)
+    hours, minutes, seconds = int(date[8:10] or 0), int(date[10:12] or 0), int(date[12:14] or 0)
+
+    # datetime.date checks the day is valid
+    dayEpoch = xmltvDayCache.get(date[0:8])
+    if dayEpoch is None:
+        dayEpoch = xmltvDayCache[date[0:8]] = (datetime.date(int(date[0:4]), int(date[4:6]), int(date[6:8])).toordinal() - XMLTV_EPOCH_ORDINAL) * 86400
+
+    utcOffset = xmltvOffsetCache.get(offset)
+    if utcOffset is None and offset not in xmltvOffsetCache:
+        utcOffset = xmltvOffsetCache[offset] = parseXMLTVOffset(offset)
+
+    if utcOffset is None:
+        epoch = int(time.mktime((int(date[0:4]), int(date[4:6]), int(date[6:8]), hours, minutes, seconds, 0, 0, -1)))
     else:
+        epoch = dayEpoch + hours * 3600 + minutes * 60 + seconds - utcOffset
+
+    if XMLTV_DATE_CACHE_SIZE:
+        if len(xmltvDateCache) >= XMLTV_DATE_CACHE_SIZE:
+            xmltvDateCache.clear()
+        xmltvDateCache[dateString] = epoch
+    return epoch
+
+def parseXMLTVOffset(offset):
+    """
+    @param offset: the part of an XMLTV timestamp after the date, such as +0200
+    @return: offset from UTC in seconds, or None if the timestamp is in local time
+    """
+    offset = offset.strip()
+    if len(offset) != 5 or offset[0] not in '+-' or not offset[1:].isdigit():
+        return None
+    utcOffset = int(offset[1:3]) * 3600 + int(offset[3:5]) * 60
+    if offset[0] == '-':
+        return -utcOffset
+    return utcOffset
+
+class XMLTVParser(object):
+    """
+    Streaming XMLTV parser on expat. Only the attributes and the text of the child elements used for
+    Program and Channel are kept, no element tree is built.
+
+    Like ElementTree's findtext(..) and find(..), a field is the text of the first child element with its name,
+    up to that element's first child, and the icon is the src of the first icon element.
+
+    Programmes of channels not accepted by channelFilter are read up to their end tag without keeping anything.
+    """
+    # bytes fed to expat at a time
+    CHUNK_SIZE = 65536
+    PROGRAMME_FIELDS = ['title', 'desc']
+    CHANNEL_FIELDS = ['display-name']
+
+    def __init__(self, logoFolder, channelFilter = None):
+        """
+        @param channelFilter: ChannelFilter of the programmes to read, all programmes are read if None
+        @type channelFilter: ChannelFilter
+        """
+        self.logoFolder = logoFolder
+        self.channelFilter = channelFilter
+        self.results = list()
+        self.depth = 0
+        self.element = None
+        self.elementDepth = 0
+        self.attributes = None
+        self.fields = None
+        self.field = None
+        self.text = None
+
+        self.parser = expat.ParserCreate()
+        self.parser.buffer_text = True
+        self.parser.StartElementHandler = self._startElement
+        self.parser.EndElementHandler = self._endElement
+        self.parser.CharacterDataHandler = self._characterData
+
+    def feed(self, data, isFinal = False):
+        """
+        @return: list of the Program and Channel objects completed by the data
+        """
+        self.parser.Parse(data, isFinal)
+        results = self.results
+        self.results = list()
+        return results
+
+    def _startElement(self, name, attributes):
+        self.depth += 1
+        if self.element is None:
+            if name == 'programme' and self.channelFilter is not None and not self.channelFilter.accepts(attributes.get('channel')):
+                self._skipProgramme()
+            elif name == 'programme' or name == 'channel':
+                self.element = name
+                self.elementDepth = self.depth
+                self.attributes = attributes
+                self.fields = dict()
+        elif self.depth == self.elementDepth + 1:
+            if name == 'icon':
+                if 'icon' not in self.fields:
+                    self.fields['icon'] = attributes.get('src')
+            elif name not in self.fields and name in (self.PROGRAMME_FIELDS if self.element == 'programme' else self.CHANNEL_FIELDS):
+                self.field = name
+                self.text = list()
+        elif self.field is not None and self.text is not None:
+            # text after a child element of the field is not part of it
+            self.fields[self.field] = ''.join(self.text)
+            self.text = None
+
+    def _endElement(self, name):
+        if self.element is not None:
+            if self.depth == self.elementDepth + 1 and self.field is not None:
+                if self.text is not None:
+                    self.fields[self.field] = ''.join(self.text)
+                self.field = self.text = None
+            elif self.depth == self.elementDepth:
+                self.results.append(self._createResult())
+                self.element = self.attributes = self.fields = None
+        self.depth -= 1
+
+    def _skipProgramme(self):
+        """
+        Ignore the programme just started up to its end tag. Programmes don't contain programmes, so until then
+        expat only reports end tags and no start tags or text.
+        """
+        self.parser.StartElementHandler = None
+        self.parser.EndElementHandler = self._endSkippedProgramme
+        self.parser.CharacterDataHandler = None
+
+    def _endSkippedProgramme(self, name):
+        if name == 'programme':
+            self.parser.StartElementHandler = self._startElement
+            self.parser.EndElementHandler = self._endElement
+            self.parser.CharacterDataHandler = self._characterData
+            self.depth -= 1
+
+    def _characterData(self, data):
+        if self.text is not None and self.depth == self.elementDepth + 1:
+            self.text.append(data)
+
+    def _createResult(self):
+        fields = self.fields
+        if self.element == 'programme':
+            return Program(self.attributes.get('channel'), fields.get('title'), parseXMLTVDate(self.attributes.get('start')),
+                           parseXMLTVDate(self.attributes.get('stop')), fields.get('desc') or None, imageSmall = fields.get('icon'))
+
+        title = fields.get('display-name')
+        return Channel(self.attributes.get('id'), title, xmltvChannelLogo(self.logoFolder, title, fields.get('icon')))
+
+def xmltvChannelLogo(logoFolder, title, icon):
+    """
+    @return: the logo named after the channel title in logoFolder if there is one, otherwise the icon of the channel
+    """
+    logo = None
+    if logoFolder:
+        logoFile = os.path.join(logoFolder.encode('utf-8', 'ignore'), title.encode('utf-8', 'ignore') + '.png')
+        if xbmcvfs.exists(logoFile):
+            logo = logoFile
+    if not logo:
+        logo = icon
+    return logo
+
+def getXMLTVParseProcesses(addon):
+    """
+    @return: number of processes parsing an XMLTV file, as set in the advanced settings
+    """
+    try:
+        return max(1, int(addon.getSetting('xmltv.parse.processes')))
+    except ValueError:
+        return XMLTV_PARSE_PROCESSES
+
+def parseXMLTVFile(path, logoFolder, progress_callback, processes = None, channelFilter = None):
+    """
+    Parse an XMLTV file, in parallel when more than one process is used and the file can be split.
+
+    @param processes: number of processes, XMLTV_PARSE_PROCESSES if None
+    @param channelFilter: ChannelFilter of the programmes to read, see XMLTVParser
+    """
+    if processes is None:
+        processes = XMLTV_PARSE_PROCESSES
+    size = os.path.getsize(path)
+    # without fork, as on Windows, a worker process would be started by running XBMC itself
+    if processes > 1 and multiprocessing is not None and hasattr(os, 'fork'):
+        split = splitXMLTVFile(path, size, processes * XMLTV_RANGES_PER_PROCESS)
+        if split is not None:
+            header, rootEndTag, ranges = split
+            return parseXMLTVRanges(path, size, header, rootEndTag, ranges, logoFolder, progress_callback, processes, channelFilter)
+    return parseXMLTV(open(path, 'rb'), size, logoFolder, progress_callback, channelFilter)
+
+def parseXMLTV(f, size, logoFolder, progress_callback, channelFilter = None):
+    parser = XMLTVParser(logoFolder, channelFilter)
+
+    while True:
+        data = f.read(XMLTVParser.CHUNK_SIZE)
+        # progress is reported per block, with a channelFilter most blocks may yield nothing
+        if progress_callback and not progress_callback(100.0 / size * f.tell()):
+            raise SourceUpdateCanceledException()
+        for result in parser.feed(data, not data):
+            yield result
+        if not data:
+            break
+    f.close()
+
+# a range of an XMLTV file starts at a programme start tag following the end of another element
+XMLTV_RANGE_START = re.compile(r'>\s*(<programme)[\s>]')
+
+def splitXMLTVFile(path, size, count):
+    """
+    Find where an XMLTV file can be split into about count byte ranges of whole programme and channel elements.
+    Only a block of the file is read at each split.
+
+    @return: tuple of the text before the first element, the end tag of the root element and a list of tuples
+        of the start and end of each range, or None if the file can't be split
+    """
+    f = open(path, 'rb')
+    try:
+        head = f.read(XMLTVParser.CHUNK_SIZE)
+        firstElements = [idx for idx in [head.find('<channel'), head.find('<programme')] if idx >= 0]
+        if not firstElements:
+            return None
+        header = head[:min(firstElements)]
+        rootNames = re.findall(r'<([A-Za-z_][\w.:-]*)', header)
+        if not rootNames:
+            return None
+
+        starts = [0]
+        for idx in range(1, count):
+            start = findXMLTVRangeStart(f, max(size * idx / count, starts[-1] + 1))
+            if start is None:
+                break
+            if start > starts[-1]:
+                starts.append(start)
+    finally:
+        f.close()
+
+    if len(starts) < 2:
         return None
+    return header, '</%s>' % rootNames[-1], zip(starts, starts[1:] + [size])
+
+def findXMLTVRangeStart(f, offset):
+    """
+    @return: position of the first programme start tag at or after offset, or None
+    """
+    f.seek(offset)
+    position = offset
+    data = ''
+    while True:
+        block = f.read(XMLTVParser.CHUNK_SIZE)
+        if not block:
+            return None
+        data += block
+        match = XMLTV_RANGE_START.search(data)
+        if match:
+            return position + match.start(1)
+        # keep the end of the block, a start tag may continue in the next block
+        keep = min(len(data), 64)
+        position += len(data) - keep
+        data = data[-keep:]
+
+def parseXMLTVRange(args):
+    """
+    Runs in a worker process of parseXMLTVRanges(..). The range is parsed as a document of its own, with the
+    header of the file in front of it and the end tag of the root element after it.
+
+    @param args: tuple of the path, header, end tag of the root element, start and end of the range, whether
+        the range is the last one and the ChannelFilter or None
+    @return: list of tuples of the fields of Program and Channel objects, they are faster to send back than objects
+    """
+    path, header, rootEndTag, start, end, isLast, channelFilter = args
+    parser = XMLTVParser(None, channelFilter)
+    results = list()
+    f = open(path, 'rb')
+    try:
+        f.seek(start)
+        if start > 0:
+            results.extend(parser.feed(header))
+        remaining = end - start
+        while remaining > 0:
+            data = f.read(min(XMLTVParser.CHUNK_SIZE, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+            results.extend(parser.feed(data))
+        results.extend(parser.feed('' if isLast else rootEndTag, True))
+    finally:
+        f.close()
+
+    fields = list()
+    for result in results:
+        if isinstance(result, Channel):
+            fields.append((result.id, result.title, result.logo))
+        else:
+            fields.append((result.channel, result.title, result.startDate, result.endDate, result.description, result.imageSmall))
+    return fields
+
+def parseXMLTVRanges(path, size, header, rootEndTag, ranges, logoFolder, progress_callback, processes, channelFilter):
+    """
+    Parse the byte ranges of an XMLTV file in worker processes. The results of each range are yielded in the order
+    of the file, so they are the same as those of parseXMLTV(..). The ranges are parsed in this process when the
+    worker processes can't be started, as on platforms without a working sem_open, or when they end unexpectedly.
+    """
+    rangeArgs = [(path, header, rootEndTag, start, end, end == size, channelFilter) for start, end in ranges]
+    tasks = None
+    workers = list()
+    try:
+        tasks = multiprocessing.Queue()
+        results = multiprocessing.Queue()
+        for idx, args in enumerate(rangeArgs):
+            tasks.put((idx, args))
+
+        for idx in range(min(processes, len(ranges))):
+            tasks.put(None)
+            worker = multiprocessing.Process(target = parseXMLTVRangesWorker, args = (tasks, results))
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+    except Exception, ex:
+        xbmc.log('[script.tvguide] Unable to start XMLTV worker processes, parsing in one process: %s' % str(ex), xbmc.LOGWARNING)
+        stopXMLTVWorkers(tasks, workers)
+        workers = list()
+
+    try:
+        elements_parsed = 0
+        parsedRanges = dict()
+        for idx, (start, end) in enumerate(ranges):
+            while workers and idx not in parsedRanges:
+                rangeIdx, fields, error = getXMLTVRangeResult(results, workers)
+                if rangeIdx is None:
+                    xbmc.log('[script.tvguide] XMLTV worker processes ended unexpectedly, parsing in one process', xbmc.LOGWARNING)
+                    stopXMLTVWorkers(tasks, workers)
+                    workers = list()
+                elif error is not None:
+                    raise error
+                else:
+                    parsedRanges[rangeIdx] = fields
+
+            if idx in parsedRanges:
+                fields = parsedRanges.pop(idx)
+            else:
+                fields = parseXMLTVRange(rangeArgs[idx])
+            if progress_callback and not progress_callback(100.0 / size * start):
+                raise SourceUpdateCanceledException()
+            for fieldIdx, field in enumerate(fields):
+                if len(field) == 3:
+                    result = Channel(field[0], field[1], xmltvChannelLogo(logoFolder, field[1], field[2]))
+                else:
+                    result = Program(field[0], field[1], field[2], field[3], field[4], imageSmall = field[5])
 
-def parseXMLTV(context, f, size, logoFolder, progress_callback):
-    event, root = context.next()
-    elements_parsed = 0
-
-    for event, elem in context:
-        if event == "end":
-            result = None
-            if elem.tag == "programme":
-                channel = elem.get("channel")
-                description = elem.findtext("desc")
-                iconElement = elem.find("icon")
-                icon = None
-                if iconElement is not None:
-                    icon = iconElement.get("src")
-                if not description:
-                    description = strings(NO_DESCRIPTION)
-                result = Program(channel, elem.findtext('title'), parseXMLTVDate(elem.get('start')), parseXMLTVDate(elem.get('stop')), description, imageSmall=icon)
-
-            elif elem.tag == "channel":
-                id = elem.get("id")
-                title = elem.findtext("display-name")
-                logo = None
-                if logoFolder:
-                    logoFile = os.path.join(logoFolder.encode('utf-8', 'ignore'), title.encode('utf-8', 'ignore') + '.png')
-                    if xbmcvfs.exists(logoFile):
-                        logo = logoFile
-                if not logo:
-                    iconElement = elem.find("icon")
-                    if iconElement is not None:
-                        logo = iconElement.get("src")
-                result = Channel(id, title, logo)
-
-            if result:
                 elements_parsed += 1
                 if progress_callback and elements_parsed % 500 == 0:
-                    if not progress_callback(100.0 / size * f.tell()):
+                    if not progress_callback(100.0 / size * (start + (end - start) * fieldIdx / len(fields))):
                         raise SourceUpdateCanceledException()
                 yield result
-
-        root.clear()
-    f.close()
+    finally:
+        stopXMLTVWorkers(tasks, workers)
+
+def stopXMLTVWorkers(tasks, workers):
+    """
+    Stops the workers when cancelled or when parsing failed, a worker may be blocked sending a result
+    so they are stopped instead of waiting for them to finish.
+    """
+    for worker in workers:
+        worker.terminate()
+        worker.join()
+    if tasks is not None:
+        tasks.cancel_join_thread()
+
+def parseXMLTVRangesWorker(tasks, results):
+    """
+    Runs in a worker process of parseXMLTVRanges(..), parses ranges until it gets None.
+    """
+    for idx, args in iter(tasks.get, None):
+        try:
+            results.put((idx, parseXMLTVRange(args), None))
+        except Exception, ex:
+            results.put((idx, None, ex))
+
+def getXMLTVRangeResult(results, workers):
+    """
+    @return: tuple of the index of a range, its fields and the exception raised parsing it, the index is None
+        if all workers ended without sending another result
+    """
+    while True:
+        try:
+            return results.get(True, 1)
+        except Queue.Empty:
+            if not [worker for worker in workers if worker.is_alive()]:
+                # a result may have been sent just before the last worker ended
+                try:
+                    return results.get(True, 1)
+                except Queue.Empty:
+                    return None, None, None
 
 class FileWrapper(object):
     def __init__(self, filename):
@@ -63,6 +63,9 @@ DATABASE_SCHEMA_ERROR_1 = 30157
 DATABASE_SCHEMA_ERROR_2 = 30158
 DATABASE_SCHEMA_ERROR_3 = 30159
 
+QUERY_PLAN_INDEX_USED = 30160
+QUERY_PLAN_INDEX_NOT_USED = 30161
+
 def strings(id, replacements = None):
     string = ADDON.getLocalizedString(id)
     if replacements is not None:
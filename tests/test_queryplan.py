@@ -0,0 +1,87 @@
+#
+#      Copyright (C) 2012 Tommy Winther
+#      http://tommy.winther.nu
+#
+#  This Program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2, or (at your option)
+#  any later version.
+#
+#  This Program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this Program; see the file LICENSE.txt.  If not, write to
+#  the Free Software Foundation, 675 Mass Ave, Cambridge, MA 02139, USA.
+#  http://www.gnu.org/copyleft/gpl.html
+#
+#  Checks that getProgramList(..) searches program_list_idx, outside XBMC. Run it from the addon folder with
+#  python -m unittest discover tests
+#
+import os
+import sys
+import types
+import unittest
+from sqlite3 import dbapi2 as sqlite3
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+
+class FakeModule(types.ModuleType):
+    """
+    Stands in for the XBMC modules and addon dependencies, which only exist inside XBMC. Every attribute
+    is a function returning None.
+    """
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return FakeAttribute()
+
+
+class FakeAttribute(object):
+    def __call__(self, *args, **kwargs):
+        return self
+
+    def __getattr__(self, name):
+        return self
+
+
+for name in ['xbmc', 'xbmcaddon', 'xbmcgui', 'xbmcvfs', 'buggalo', 'simplejson']:
+    try:
+        __import__(name)
+    except ImportError:
+        sys.modules[name] = FakeModule(name)
+
+import source as src
+
+
+class ProgramListQueryPlanTest(unittest.TestCase):
+    def setUp(self):
+        self.conn = sqlite3.connect(':memory:', detect_types = sqlite3.PARSE_DECLTYPES)
+        self.conn.row_factory = sqlite3.Row
+        # only the methods creating the tables and checking the query are used, they need no connection of the source
+        self.source = src.Source.__new__(src.Source)
+        c = self.conn.cursor()
+        self.source._createTables(c)
+        self.conn.commit()
+
+    def tearDown(self):
+        self.conn.close()
+
+    def testProgramListIdxIsSearched(self):
+        (usesIndex, plan) = self.source._checkProgramListQueryPlan(self.conn.cursor())
+        self.assertTrue(usesIndex, '; '.join(plan))
+
+    def testSwappedIndexIsSearched(self):
+        # the staging tables of an import are swapped in with their indexes named program_list_idx_swap
+        c = self.conn.cursor()
+        c.execute('DROP INDEX %s' % src.Source.PROGRAM_INDEXES[0][0])
+        c.execute('CREATE INDEX %s_swap ON programs%s' % src.Source.PROGRAM_INDEXES[0])
+        (usesIndex, plan) = self.source._checkProgramListQueryPlan(c)
+        self.assertTrue(usesIndex, '; '.join(plan))
+
+
+if __name__ == '__main__':
+    unittest.main()